@@ -23,10 +23,10 @@
 
 # Extended notes:
 # user:
-#     user objects are objects containing some information about the user who
-#     said anything. This information consists of user.id, user.rank, and
-#     user.name. user.id is a format-removed id of the speaker with only a-z
-#     lowercase and 0-9 present.
+#     user objects are Member objects containing some information about the
+#     user who said anything in a room. This information consists of user.id,
+#     user.rank, and user.name. user.id is a format-removed id of the speaker
+#     with only a-z lowercase and 0-9 present.
 #
 #     user.rank contain the auth level of the user, as a single character
 #     string of either ' ', +, %, @, &, #, or ~. To compare groups against each
@@ -46,10 +46,12 @@ from commands import IgnoreBroadcastPermission
 from commands import IgnoreEscaping
 from robot import PokemonShowdownBot
 from robot import Room
-from robot import User
+from robot import users
 from plugins.battling.battleHandler import supportedFormats
 from plugins import moderation
 from plugins.messages import MessageDatabase
+from plugins.modqueue import ModerationQueue
+from plugins.statestore import SQLiteBackend
 from plugins.workshop import Workshop
 
 
@@ -69,6 +71,8 @@ class PSBot(PokemonShowdownBot):
     Attributes:
         do: Command object which handles '.command' actions from the user
         usernotes: MessageDatabase object which handles all PMs sent from users
+        modqueue: ModerationQueue object which moderates chat messages away
+                  from the thread receiving them
     """
     def __init__(self):
         """Initializes the PSBot class
@@ -78,10 +82,13 @@ class PSBot(PokemonShowdownBot):
         """
         self.do = Command
         self.usernotes = MessageDatabase()
+        self.modqueue = ModerationQueue(self.punish)
         PokemonShowdownBot.__init__(self,
                                     ("ws://sim.smogon.com:8000/showdown/"
                                      "websocket"),
                                     self.splitMessage)
+        if self.details.get('modstate'):
+            moderation.useStateBackend(SQLiteBackend(self.details['modstate']))
 
     def splitMessage(self, ws, message):
         """ Splits the string received and delegates tasks to modules
@@ -140,8 +147,7 @@ class PSBot(PokemonShowdownBot):
         if self.userIsSelf(message[1:]):
             room.rank = message[0]
             room.doneLoading()
-        userid = self.toId(message)
-        user = User(userid, message[0], self.isOwner(userid))
+        user = users.member(message[1:], message[0])
         # block banned users from this room
         if moderation.shouldBan(self, user, room):
             self.takeAction(room.title, user, "roomban", ("You are blacklisted"
@@ -152,6 +158,23 @@ class PSBot(PokemonShowdownBot):
         if self.usernotes.shouldNotifyMessage(user.id):
             self.sendPm(user.id, self.usernotes.pendingMessages(user.id))
 
+    def punish(self, room, user, wrong, unixTime):
+        """Decides on and takes action against a user for a violation
+
+        Args:
+            room: Room object the violation happened in.
+            user: User object of the offending user.
+            wrong: string, the kind of violation, see moderation.py.
+            unixTime: string, timestamp of the offending message.
+        Returns:
+            None.
+        Raises:
+            None.
+        """
+        action, reason = moderation.getAction(self, room, user, wrong,
+                                              unixTime)
+        self.takeAction(room.title, user, action, reason)
+
     def parseMessage(self, msg, roomName):
         """Parses the message given by a user and delegates the tasks further
 
@@ -215,8 +238,7 @@ class PSBot(PokemonShowdownBot):
 
         # Joined new room
         elif "users" in message[1]:
-            for user in message[2].split(",")[1:]:
-                room.addUser(User(user[1:], user[0], self.isOwner(user[1:])))
+            room.addUsers(users.members(message[2].split(",")[1:]))
             # If PS doesn't tell us we joined, this still give us our room rank
             room.rank = message[2][message[2].index(self.name) - 1]
 
@@ -229,7 +251,7 @@ class PSBot(PokemonShowdownBot):
                 # from a room. Any other memory release required is handeled by
                 # the room destruction
                 if roomName in self.rooms:
-                    self.rooms.pop(roomName)
+                    self.rooms.pop(roomName).clearUsers()
                 return
             userid = self.toId(message[2])
             room.removeUser(userid)
@@ -240,7 +262,7 @@ class PSBot(PokemonShowdownBot):
             if self.userIsSelf(message[2][1:]):
                 room.rank = message[2][0]
             oldName = self.toId(message[3])
-            room.renamedUser(oldName, User(message[2][1:], message[2][0]))
+            room.renamedUser(oldName, users.member(message[2][1:], message[2][0]))
 
         # Chat messages
         elif "c" in message[1].lower():
@@ -255,12 +277,7 @@ class PSBot(PokemonShowdownBot):
 
             # perform moderation on user content
             if room.moderate and self.canPunish(room):
-                anything = moderation.shouldAct(message[4], user, room,
-                                                message[2])
-                if anything:
-                    action, reason = moderation.getAction(self, room, user,
-                                                          anything, message[2])
-                    self.takeAction(room.title, user, action, reason)
+                self.modqueue.put(message[4], user, room, message[2])
 
             #update clever bot with last message
             if not message[4].startswith(self.commandchar):
@@ -277,7 +294,7 @@ class PSBot(PokemonShowdownBot):
                     response = "This room does not support chatgames."
                 else:
                     parsed_msg = message[4][len(command)+1:].lstrip()
-                    if command != "m":
+                    if command not in ["m", "markovstats"]:
                         response, samePlace = self.do(self, command, room,
                                                       parsed_msg, user)
                     else:
@@ -317,8 +334,7 @@ class PSBot(PokemonShowdownBot):
                                      message[4])
 
         elif "pm" in message[1].lower():
-            user = User(message[2][1:], message[2][0],
-                        self.isOwner(self.toId(message[2])))
+            user = users.member(message[2][1:], message[2][0])
             if self.userIsSelf(user.id):
                 return
 
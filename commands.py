@@ -135,7 +135,26 @@ def Command(self, cmd, room, msg, user, room_name=None, markov_db=None):
     if cmd == "m":
         if (markov_db is not None and room_name is not None and
                 room_name in markov_db):
-            return markov_db[room_name].generateText(), True
+            if not markov_db[room_name].ready.is_set():
+                return "I'm still warming up, try again in a bit.", True
+            word = msg.strip()
+            if not word:
+                return markov_db[room_name].takeSentence(), True
+            sentence = markov_db[room_name].generateAbout(word)
+            if sentence is None:
+                return "sorry, nobody has said {w} yet.".format(w=word), False
+            return sentence, True
+        else:
+            return "sorry, there is no data for this room.", False
+
+    if cmd == "markovstats":
+        if not user.hasRank("%"):
+            return "You do not have permission to see this. (Requires %)", False
+        if (markov_db is not None and room_name is not None and
+                room_name in markov_db):
+            if not markov_db[room_name].ready.is_set():
+                return "The model of this room is still warming up.", True
+            return markov_db[room_name].stats(), True
         else:
             return "sorry, there is no data for this room.", False
 
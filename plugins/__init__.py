@@ -13,6 +13,8 @@ PluginCommands = {
     'banphrase'     : moderation.banthing,
     'unbanuser'     : moderation.unbanthing,
     'unbanphrase'   : moderation.unbanthing,
+    'modrule'       : moderation.modrule,
+    'modstats'      : moderation.modstats,
     'oldgentour'    : tournaments.oldgentour,
     'tell'          : messages.tell,
     'read'          : messages.read,
@@ -24,17 +24,17 @@ from data.pokedex import Pokedex
 from data.moves import Moves
 from data.abilities import Abilities
 from plugins.games import GenericGame
+from plugins.journal import Journal
 import re
 import random
 import datetime
-import yaml
 
-Scoreboard = {}
-with open('plugins/scoreboard.yaml', 'a+') as yf:
-    yf.seek(0, 0)
-    Scoreboard = yaml.load(yf)
-    if not Scoreboard: # Empty yaml file set Scoreboard to None, but a dict is expected
-        Scoreboard = {}
+def setScore(scores, change):
+    user, score = change
+    scores[user] = score
+# Empty yaml file set Scoreboard to None, but a dict is expected
+scoreJournal = Journal('plugins/scoreboard.yaml', lambda data: data or {}, setScore)
+Scoreboard = scoreJournal.state
 
 class Anagram(GenericGame):
     def __init__(self):
@@ -113,8 +113,6 @@ def answer(bot, cmd, room, msg, user):
         timeTaken = room.game.getSolveTimeStr()
         room.game = None
         # Save score
-        Scoreboard[user.id] = 1 if user.id not in Scoreboard else Scoreboard[user.id] + 1
-        with open('plugins/scoreboard.yaml', 'w') as ym:
-            yaml.dump(Scoreboard, ym)
+        scoreJournal.record(user.id, 1 if user.id not in Scoreboard else Scoreboard[user.id] + 1)
         return 'Congratulations, {name} got it{time}\nThe solution was: {solution}'.format(name = user.name, time = timeTaken, solution = solved), True
     return '{test} is wrong!'.format(test = msg.lstrip()), True
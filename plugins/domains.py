@@ -0,0 +1,103 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 QuiteQuiet
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Host checks against the link whitelists and url shorteners. Rooms keep
+# their own whitelist too, so this is used outside of moderation as well.
+
+
+class DomainIndex:
+    """A set of domains that hosts can be checked against label by label.
+
+    Domains are stored in a trie keyed on their labels in reverse, so finding
+    'i.imgur.com' walks 'com' -> 'imgur' -> 'i' and a lookup costs one dict
+    access per label no matter how many domains are indexed.
+    An entry like 'smogon.com' matches the domain and all of its subdomains,
+    '.psim.us' only matches subdomains and 'to.' only matches the bare host.
+    """
+    EXACT = 1
+    SUBDOMAINS = 2
+
+    def __init__(self, domains = ()):
+        self.trie = {}
+        self.domains = set()
+        for domain in domains:
+            self.add(domain)
+
+    def __iter__(self):
+        return iter(sorted(self.domains))
+
+    def __len__(self):
+        return len(self.domains)
+
+    def _parse(self, domain):
+        domain = domain.strip().lower()
+        flags = self.EXACT | self.SUBDOMAINS
+        if domain.startswith('.'):
+            flags = self.SUBDOMAINS
+        elif domain.endswith('.'):
+            flags = self.EXACT
+        return domain, [l for l in reversed(domain.split('.')) if l], flags
+
+    def add(self, domain):
+        domain, labels, flags = self._parse(domain)
+        if not labels or domain in self.domains:
+            return False
+        node = self.trie
+        for label in labels:
+            node = node.setdefault(label, {})
+        # Labels are never empty, so '' is free to hold the match flags
+        node[''] = node.get('', 0) | flags
+        self.domains.add(domain)
+        return True
+
+    def remove(self, domain):
+        domain, labels, flags = self._parse(domain)
+        if domain not in self.domains:
+            return False
+        node = self.trie
+        for label in labels:
+            node = node[label]
+        self.domains.remove(domain)
+        # 'psim.us', '.psim.us' and 'psim.us.' all share one node, so rebuild
+        # its flags from whichever of them are still indexed
+        node[''] = 0
+        for other in (domain.strip('.'), '.' + domain.strip('.'), domain.strip('.') + '.'):
+            if other in self.domains:
+                node[''] |= self._parse(other)[2]
+        return True
+
+    def matches(self, host):
+        if not host:
+            return False
+        labels = host.lower().rstrip('.').split('.')
+        node = self.trie
+        last = len(labels) - 1
+        for i, label in enumerate(reversed(labels)):
+            node = node.get(label)
+            if node is None:
+                return False
+            flags = node.get('', 0)
+            if i == last and flags & self.EXACT:
+                return True
+            if i < last and flags & self.SUBDOMAINS:
+                return True
+        return False
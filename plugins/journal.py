@@ -0,0 +1,128 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 QuiteQuiet
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Rewriting a whole yaml file on every change gets slow as the file grows and
+# leaves a broken file behind if the bot dies halfway through. A Journal keeps
+# the yaml file as a snapshot and appends every change to a log next to it,
+# folding the log back into the snapshot once it grows long enough.
+
+import json
+import os
+import tempfile
+
+import yaml
+
+
+def atomicWrite(path, write, mode = 'w'):
+    """Writes a file so that it is never seen half written.
+
+    Args:
+        path: string, path of the file to write.
+        write: function taking the open file that writes the contents.
+        mode: string, 'w' for text or 'wb' for bytes.
+    """
+    directory = os.path.dirname(path) or '.'
+    with tempfile.NamedTemporaryFile(mode, dir = directory, delete = False,
+                                     suffix = '.tmp') as tmp:
+        write(tmp)
+        tmp.flush()
+        os.fsync(tmp.fileno())
+    # Renaming over the old file is atomic, so the file on disk is always
+    # complete
+    os.replace(tmp.name, path)
+
+
+class Journal:
+    """A yaml snapshot plus an append-only log of the changes made since.
+
+    Changes are lists of json values handed to apply(). They have to give
+    the same result when applied twice, as the log is replayed over the
+    snapshot when loading and a crash during compact() can leave changes
+    that are already part of the snapshot in the log.
+
+    Loading only reads the files. The log is opened, and whatever an earlier
+    run left in it folded into the snapshot, on the first record(), so
+    tools that only read the state leave the files alone.
+
+    Attributes:
+        path: string, path of the yaml snapshot. The log is kept in the same
+              place with '.journal' added to the name.
+        state: the data as of the last change.
+        apply: function taking (state, change) that applies the change.
+        encode: function turning the state into something yaml can dump.
+        compactAfter: int, changes logged before they go into the snapshot.
+    """
+    def __init__(self, path, decode, apply, encode = lambda state: state,
+                 compactAfter = 1000):
+        self.path = path
+        self.logPath = path + '.journal'
+        self.apply = apply
+        self.encode = encode
+        self.compactAfter = compactAfter
+        self.logged = 0
+        data = None
+        if os.path.exists(path):
+            with open(path, 'r') as yf:
+                data = yaml.safe_load(yf)
+        self.state = decode(data)
+        self.replay()
+        self.log = None
+
+    def replay(self):
+        if not os.path.exists(self.logPath):
+            return
+        with open(self.logPath, 'r') as log:
+            for line in log:
+                try:
+                    change = json.loads(line)
+                except ValueError:
+                    # The last line can be cut off if the bot died writing it
+                    break
+                self.apply(self.state, change)
+                self.logged += 1
+
+    def openLog(self):
+        self.log = open(self.logPath, 'a')
+        if self.logged:
+            self.compact()
+
+    def record(self, *change):
+        """Applies a change and appends it to the log."""
+        if self.log is None:
+            self.openLog()
+        self.apply(self.state, list(change))
+        self.log.write(json.dumps(change) + '\n')
+        self.log.flush()
+        self.logged += 1
+        if self.logged >= self.compactAfter:
+            self.compact()
+
+    def compact(self):
+        """Writes the state to the snapshot and empties the log."""
+        atomicWrite(self.path, lambda snapshot: yaml.dump(self.encode(self.state), snapshot))
+        self.log.truncate(0)
+        self.logged = 0
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
@@ -0,0 +1,148 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 QuiteQuiet
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Shortened links have to be followed to know where they lead, which can take
+# seconds for a slow redirect. Resolving them here keeps that work off the
+# thread that handles chat messages.
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+import requests
+
+
+class ExpiringCache:
+    """A least recently used cache where entries also expire after a while.
+
+    Attributes:
+        maxsize: int, the most entries held before the oldest are dropped.
+        ttl: float, seconds an entry stays valid after being stored.
+    """
+    def __init__(self, maxsize = 1024, ttl = 3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """Returns a pair of (found, value) for the key."""
+        with self.lock:
+            if key not in self.entries:
+                return False, None
+            value, expires = self.entries[key]
+            if expires <= time.monotonic():
+                del self.entries[key]
+                return False, None
+            self.entries.move_to_end(key)
+            return True, value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last = False)
+
+
+class LinkResolver:
+    """Follows redirects of links on a small pool of worker threads.
+
+    Every worker keeps its own requests.Session so connections to the same
+    shortener are reused. Lookups of a link that is already being resolved
+    wait on the same request instead of starting a new one.
+
+    Attributes:
+        timeout: float, seconds allowed for connecting and for reading.
+        cache: ExpiringCache, maps links to where they lead. An empty string
+               means the link could not be resolved.
+    """
+    def __init__(self, workers = 2, timeout = 3, maxRedirects = 5, cache = None):
+        self.timeout = timeout
+        self.maxRedirects = maxRedirects
+        self.cache = cache if cache is not None else ExpiringCache()
+        self.pool = ThreadPoolExecutor(max_workers = workers)
+        self.local = threading.local()
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def session(self):
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.Session()
+            self.local.session.max_redirects = self.maxRedirects
+        return self.local.session
+
+    def lookup(self, link):
+        """Returns a pair of (resolved, target) without blocking."""
+        return self.cache.get(link)
+
+    def resolve(self, link, callback):
+        """Resolves the link in the background.
+
+        Args:
+            link: string, the link to follow.
+            callback: function taking the target the link leads to, or an
+                      empty string if it couldn't be followed. Called from a
+                      worker thread, or right away if the link is cached.
+        """
+        found, target = self.cache.get(link)
+        if found:
+            callback(target)
+            return
+        with self.lock:
+            if link in self.pending:
+                self.pending[link].append(callback)
+                return
+            self.pending[link] = [callback]
+        self.pool.submit(self.work, link)
+
+    def work(self, link):
+        target = self.fetch(link)
+        self.cache.put(link, target)
+        with self.lock:
+            callbacks = self.pending.pop(link, [])
+        for callback in callbacks:
+            try:
+                callback(target)
+            except Exception as e:
+                print('Link resolver callback failed:', e)
+
+    def fetch(self, link):
+        if not link.startswith(('http://', 'https://')):
+            link = 'http://' + link
+        try:
+            resp = self.session().head(link, allow_redirects = True,
+                                       timeout = self.timeout)
+            # Some shorteners don't answer HEAD, only ask for the body then
+            if resp.status_code >= 400:
+                resp = self.session().get(link, allow_redirects = True,
+                                          timeout = self.timeout, stream = True)
+                resp.close()
+            if resp.status_code >= 400:
+                return ''
+            return resp.url
+        except (requests.RequestException, ValueError):
+            return ''
@@ -23,7 +23,388 @@
 # credit to Shadba Raaj for sample code that this was adapted from
 # http://agiliq.com/blog/2009/06/generating-pseudo-random-text-with-markov-chains-u/
 
+from array import array
+import atexit
+import bisect
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+from itertools import accumulate
+import os
+import pickle
 import random
+import sys
+from threading import Condition, Event, Lock, RLock, Thread
+import time
+import weakref
+
+from plugins.journal import atomicWrite
+
+# Bump this whenever what goes into a snapshot changes, so old snapshots are
+# rebuilt from the room's text file instead of being loaded
+SNAPSHOT_VERSION = 3
+SNAPSHOT_HEADER = 'markov-snapshot {version}\n'.format(version = SNAPSHOT_VERSION).encode()
+# How much of the start of the text file a snapshot remembers a hash of, to
+# notice when the file was replaced
+SNAPSHOT_HEAD_BYTES = 4096
+# Writing a snapshot costs more than training on a few new lines, so it is
+# only rewritten once this many bytes of the text file weren't in it
+SNAPSHOT_MIN_TAIL = 1 << 20
+# Tuples followed by fewer words than this are quicker to walk through than
+# to build a sampler for
+SAMPLER_MIN_WORDS = 16
+# Rough bytes a key of the cache takes with its place in the index, and an
+# array of successors on top of the bytes of its items. Used to tell how big
+# a model has grown
+KEY_BYTES = 136
+ARRAY_BYTES = 64
+# Memory a model may use, and how far under it pruning goes, so it doesn't
+# have to prune again right away. Rooms using the shared model only keep a
+# small store of their own on top of it
+DEFAULT_BUDGET = 64 << 20
+ROOM_BUDGET = 8 << 20
+PRUNE_TARGET = 0.75
+# Keys pruned in one go, before training gets a turn again
+PRUNE_BATCH = 1000
+# How much the vocabulary grows before it is swept again, as a sweep goes
+# through every model
+SWEEP_GROWTH = 1.25
+# How likely a room is to follow its own rules rather than the shared ones,
+# when both know the words so far
+DEFAULT_WEIGHT = 0.5
+# Sentences kept ready for ~m in every room, how many lines a room may train
+# on before those are thrown away for newer ones, and seconds to leave
+# between making two sentences so the bot isn't held up
+POOL_SIZE = 5
+POOL_STALE_LINES = 100
+POOL_PAUSE = 0.05
+# Words a sentence may take, cyclic chains could go on forever otherwise
+MAX_STEPS = 200
+# Threads loading models in the background, see Markov.load, and seconds a
+# room waits for the shared model to load before loading without it
+LOAD_THREADS = 4
+SHARED_WAIT = 120
+# The id of the whitespace word that marks where sentences start and end
+EDGE = 0
+
+def packKey(w1, w2, w3):
+    """Packs the ids of three words into one int, for keying the cache."""
+    return (w1 << 64) | (w2 << 32) | w3
+
+def packSuccessors(counts):
+    """Returns the cache entry for a map of word ids to how often they
+    followed a key.
+    """
+    if len(counts) == 1:
+        (word, count), = counts.items()
+        return (word << 32) | count
+    return array('I', list(counts.keys()) + list(counts.values()))
+
+def usedWords(items):
+    """Returns the ids of the words in the (key, successors) pairs of a cache."""
+    used = {EDGE}
+    for key, successors in items:
+        used.update((key >> 64, (key >> 32) & 0xffffffff, key & 0xffffffff))
+        if isinstance(successors, array):
+            used.update(successors[:len(successors) // 2])
+        else:
+            used.add(successors >> 32)
+    return used
+
+def corpusHead(file_name, offset):
+    """Returns a hash of the start of a text file."""
+    with open(file_name, 'rb') as open_file:
+        return hashlib.sha1(open_file.read(min(offset, SNAPSHOT_HEAD_BYTES))).hexdigest()
+
+def writeSnapshot(snapshot_name, files, words, cache):
+    """Writes the rules of a model trained on the given bytes of text files.
+
+    Args:
+        snapshot_name: string, path to write the snapshot to.
+        files: maps the text files trained on to how many of their bytes.
+        words: list of str, the word for every id. Only the words the cache
+               has are written, the others are left as None.
+        cache: the rules, see Markov.
+    """
+    used = usedWords(cache.items())
+    words = [word if word_id in used else None for word_id, word in enumerate(words)]
+    while words and words[-1] is None:
+        words.pop()
+    data = {'files': {file_name: (offset, corpusHead(file_name, offset))
+                      for file_name, offset in files.items()},
+            'words': words, 'cache': cache}
+    def write(snapshot):
+        snapshot.write(SNAPSHOT_HEADER)
+        pickle.dump(data, snapshot, pickle.HIGHEST_PROTOCOL)
+    atomicWrite(snapshot_name, write, 'wb')
+
+class Vocabulary(object):
+    """Gives every word an integer id.
+
+    The word strings are interned, so a word is only kept once however many
+    vocabularies have it. Words no model has anymore, such as after pruning,
+    are dropped by sweep and their ids given out again.
+
+    Attributes:
+        words: list of str, the word for every id, None for free ids.
+        ids: maps a word to its id.
+        free: set of int, the ids without a word.
+        models: the Markov objects numbering their words with this, whose
+                words sweep keeps. Models no longer used elsewhere are
+                forgotten.
+        lock: RLock, held while giving out ids, as models loading at the same
+              time share the vocabulary.
+        sweeping: Bool, if sweep is finding the words in use. Ids handed out
+                  meanwhile are kept in touched, as they may be trained on
+                  after sweep went through the model.
+    """
+    def __init__(self, words = (' ',)):
+        self.words = []
+        self.ids = {}
+        self.free = set()
+        self.models = weakref.WeakSet()
+        self.lock = RLock()
+        self.sweeping = False
+        self.touched = set()
+        self.swept = 0
+        for word in words:
+            self.id(word)
+
+    def id(self, word):
+        """Returns the id of a word, giving it one if it has none yet."""
+        word_id = self.ids.get(word)
+        if word_id is None or self.sweeping:
+            with self.lock:
+                word_id = self.ids.get(word)
+                if word_id is None:
+                    word = sys.intern(word)
+                    if self.free:
+                        word_id = self.free.pop()
+                        self.words[word_id] = word
+                    else:
+                        word_id = len(self.words)
+                        self.words.append(word)
+                    self.ids[word] = word_id
+                if self.sweeping:
+                    self.touched.add(word_id)
+        return word_id
+
+    def claim(self, words):
+        """Gives words the ids of their places in the list, if none of them
+        has another id and none of those ids has another word.
+
+        Args:
+            words: list of str, the word for every id, None where any word
+                   will do.
+        Returns:
+            Bool, if the words got those ids. Either all of them do or none.
+        """
+        with self.lock:
+            for word_id, word in enumerate(words):
+                if word is None:
+                    continue
+                if word_id < len(self.words) and self.words[word_id] == word:
+                    continue
+                if word in self.ids or (word_id < len(self.words) and word_id not in self.free):
+                    return False
+            for word_id, word in enumerate(words):
+                if word is None or (word_id < len(self.words) and self.words[word_id] == word):
+                    continue
+                while len(self.words) <= word_id:
+                    self.free.add(len(self.words))
+                    self.words.append(None)
+                self.free.discard(word_id)
+                word = sys.intern(word)
+                self.words[word_id] = word
+                self.ids[word] = word_id
+            if self.sweeping:
+                self.touched.update(word_id for word_id, word in enumerate(words) if word is not None)
+            return True
+
+    def sweep(self):
+        """Drops the words no model has anymore.
+
+        The caches of the models are gone through without their locks, so
+        training carries on in the meantime. Nothing happens until the
+        vocabulary has grown by SWEEP_GROWTH since the last sweep.
+        Returns:
+            int, how many words were dropped.
+        """
+        with self.lock:
+            if self.sweeping or len(self.ids) < self.swept * SWEEP_GROWTH:
+                return 0
+            self.sweeping = True
+            self.touched = set()
+        try:
+            used = set()
+            for model in list(self.models):
+                used |= usedWords(model.items())
+            with self.lock:
+                used |= self.touched
+                dropped = [word_id for word_id, word in enumerate(self.words)
+                           if word is not None and word_id not in used]
+                for word_id in dropped:
+                    del self.ids[self.words[word_id]]
+                    self.words[word_id] = None
+                self.free.update(dropped)
+                self.swept = len(self.ids)
+        finally:
+            with self.lock:
+                self.sweeping = False
+                self.touched = set()
+        return len(dropped)
+
+class CorpusWriter(object):
+    """Appends chat lines to the rooms' text files from a background thread.
+
+    Opening, writing and closing a file for every chat message is slow, and
+    used to happen on the thread receiving messages. Lines are buffered per
+    file instead, and one thread writes them out every flush_interval seconds,
+    or sooner once a file has max_buffered characters waiting. At most the
+    lines of one flush_interval are lost if the bot dies.
+
+    Attributes:
+        flush_interval: float, seconds between writes.
+        max_buffered: int, characters waiting for a file before it is
+                      written early.
+        fsync: Bool, if every write should also wait for the disk.
+    """
+    def __init__(self, flush_interval = 1.0, max_buffered = 1 << 16, fsync = False):
+        self.flush_interval = flush_interval
+        self.max_buffered = max_buffered
+        self.fsync = fsync
+        self.lock = Lock()
+        self.wake = Condition(self.lock)
+        # Only one thread writes to the files at a time
+        self.write_lock = Lock()
+        self.buffers = {}
+        self.buffered = {}
+        self.files = {}
+        self.thread = None
+        self.closed = False
+        atexit.register(self.close)
+
+    def write(self, file_name, text):
+        """Queues text to be appended to the file."""
+        with self.lock:
+            if self.thread is None:
+                self.thread = Thread(target = self.work, name = 'corpuswriter',
+                                     daemon = True)
+                self.thread.start()
+            self.buffers.setdefault(file_name, []).append(text)
+            self.buffered[file_name] = self.buffered.get(file_name, 0) + len(text)
+            if self.buffered[file_name] >= self.max_buffered:
+                self.wake.notify()
+
+    def work(self):
+        while not self.closed:
+            with self.lock:
+                deadline = time.monotonic() + self.flush_interval
+                while (not self.closed and time.monotonic() < deadline and
+                       all(size < self.max_buffered for size in self.buffered.values())):
+                    self.wake.wait(deadline - time.monotonic())
+            self.flush()
+
+    def flush(self):
+        """Writes out everything queued so far."""
+        with self.write_lock:
+            with self.lock:
+                buffers, self.buffers, self.buffered = self.buffers, {}, {}
+            for file_name, lines in buffers.items():
+                if file_name not in self.files:
+                    self.files[file_name] = open(file_name, 'a', encoding = 'utf-8')
+                open_file = self.files[file_name]
+                open_file.write(''.join(lines))
+                open_file.flush()
+                if self.fsync:
+                    os.fsync(open_file.fileno())
+
+    def close(self):
+        """Writes out everything queued and closes the files."""
+        with self.lock:
+            self.closed = True
+            self.wake.notify()
+        self.flush()
+        with self.write_lock:
+            for open_file in self.files.values():
+                open_file.close()
+            self.files.clear()
+
+# One writer serves every room
+corpus_writer = CorpusWriter()
+
+# Every model numbers its words the same way, so the rules of a room can be
+# looked up in the shared model
+vocabulary = Vocabulary()
+
+class SentenceMaker(object):
+    """Fills the sentence pools of the Markov models from a background thread.
+
+    Generating a sentence walks the chain until it ends, which takes a while
+    for big models. Sentences are made ahead of time instead, one at a time
+    with a pause in between, so ~m only has to take one from the pool.
+
+    Models that outgrew their budget while training on chat are pruned here
+    too, so the thread receiving messages doesn't have to go through their
+    whole cache, and the words pruning left unused are swept away after.
+
+    Attributes:
+        models: the Markov objects with a pool to keep filled. Models that are
+                no longer used elsewhere are forgotten.
+        overgrown: list of Markov objects waiting to be pruned.
+    """
+    def __init__(self):
+        self.models = weakref.WeakSet()
+        self.overgrown = []
+        self.lock = Lock()
+        self.wake = Condition(self.lock)
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = Thread(target = self.work, name = 'sentencemaker',
+                                 daemon = True)
+            self.thread.start()
+
+    def add(self, model):
+        with self.lock:
+            self.models.add(model)
+            self.start()
+            self.wake.notify()
+
+    def notify(self):
+        """Tells the thread that a pool needs filling."""
+        with self.lock:
+            self.wake.notify()
+
+    def prune(self, model):
+        """Has the thread prune the model."""
+        with self.lock:
+            if model not in self.overgrown:
+                self.overgrown.append(model)
+            self.start()
+            self.wake.notify()
+
+    def work(self):
+        while True:
+            with self.lock:
+                overgrown, self.overgrown = self.overgrown, []
+                hungry = [model for model in self.models if len(model.pool) < POOL_SIZE]
+                if not hungry and not overgrown:
+                    self.wake.wait()
+                    continue
+            for model in overgrown:
+                model.prune()
+            for words in {model.vocabulary for model in overgrown}:
+                words.sweep()
+            for model in hungry:
+                model.fillPool()
+                time.sleep(POOL_PAUSE)
+
+sentence_maker = SentenceMaker()
+
+# Models of rooms being joined load side by side on these threads
+model_loader = ThreadPoolExecutor(LOAD_THREADS)
 
 class Markov(object):
     """ This will generate messages based on the messages in a room.
@@ -31,59 +412,261 @@ class Markov(object):
     Specifically it will use Markov Chains to generate the messages. In this 
     case we will do it by every second word.
 
+    Most of what rooms say is common to all of them, so rather than every room
+    keeping a full model, the rooms share one which learns from all of them,
+    and only keep a small model of their own on top, see chooseId. The shared
+    model is a Markov object too, without a text file of its own.
+
     Atrributes:
         room_name: string, name of the room we are in.
         file_name: string, path to the file we are going to store the room's 
-                   messages in.
-        cache: map a pair of strings to a words occurences, this will be 
-               the rule we use to generate sentences.
-        cache_len: maps a tuple to amount of words that come after this tuple.
-        msg_cache: list of str, this will hold all the messages that have been
-                   recorded thus far.
+                   messages in. Empty for the shared model.
+        vocabulary: Vocabulary object, the ids of the words in the cache.
+        cache: map three word ids packed with packKey to the words following
+               them, this will be the rule we use to generate sentences. Most
+               keys are only ever followed by one word, which is stored as an
+               int holding its id shifted left by 32 plus its count. Others
+               have an array of the word ids followed by their counts, which
+               takes a fraction of the memory of a dict of strings.
+        shared: Markov object, the model shared by the rooms, or None.
+        weight: float, how likely the room's own rules are to be used over
+                the shared ones when both have a key.
+        budget: int, bytes the model may take before its rarest rules are
+                pruned away, see prune.
+        array_bytes: int, rough bytes taken by the successor arrays.
+        pool: deque of str, sentences made ahead of time, see SentenceMaker.
+        stale_lines: int, lines trained on since the pool was emptied.
+        lock: RLock, held while training or generating, as those happen on
+              different threads.
+        prunes: int, how many times the model was pruned.
+        pruned: int, how many keys pruning dropped in total.
+        snapshot_name: string, path to the file the trained vocabulary and
+                       cache are saved in.
+        files: maps the text files the model was trained on to how many of
+               their bytes it has been trained on.
+        unsaved: int, bytes trained on since the snapshot was written.
+        ready: Event, set once the model has loaded. Until then it can't
+               generate sentences.
+        waiting: list of str, lines said while the model was loading, which
+                 are written and trained on once it has.
+        positions: maps a key with many words after it to where each of
+                   those is in its array, so training doesn't have to search.
+        index: maps a word id to the keys that have it in the middle, to
+               find where a sentence about that word could go.
+        samplers: maps a key to the words after it and their running
+                  totals, for picking one with bisect. These are built the
+                  first time a tuple with many words after it is used and
+                  dropped when it changes.
     """
-    def __init__(self, room_name, file_name = None):
-        """Intializes the database and starts creating the rules for grammar"""
+    def __init__(self, room_name, file_name = None, snapshot_name = None,
+                 budget = DEFAULT_BUDGET, shared = None, weight = DEFAULT_WEIGHT,
+                 background = False):
+        """Intializes the database and starts creating the rules for grammar
+
+        With background set, the model is loaded by model_loader instead of
+        before returning, so joining many rooms doesn't wait on each of their
+        models in turn.
+        """
         self.room_name = room_name
         self.file_name = ''
         if file_name is None:
             self.file_name = "roomdata-"+room_name+".txt"  
         else:
             self.file_name = file_name
+        if snapshot_name is None:
+            self.snapshot_name = os.path.splitext(self.file_name or "roomdata-"+room_name)[0] + '.markov'
+        else:
+            self.snapshot_name = snapshot_name
+        self.shared = shared
+        self.weight = weight
+        self.budget = budget
+        self.vocabulary = vocabulary
+        self.vocabulary.models.add(self)
         self.cache = {}
-        self.cache_len = {}
-        self.msg_cache = list(self.getFromFile())
-        for msg in self.msg_cache:
-            orig_msg = ''
-            for word in msg:
-                orig_msg += word + ' '
-            self.updateDatabase(orig_msg.strip())
+        self.positions = {}
+        self.samplers = {}
+        self.index = {}
+        self.array_bytes = 0
+        self.pool = deque()
+        self.stale_lines = 0
+        self.lock = RLock()
+        self.prunes = 0
+        self.pruned = 0
+        self.files = {}
+        self.unsaved = 0
+        self.ready = Event()
+        self.waiting = []
+        if background:
+            model_loader.submit(self.load).add_done_callback(self.loadDone)
+        else:
+            self.load()
+
+    def load(self):
+        """Loads the rules of the model.
+
+        Training on the whole text file takes a while for busy rooms, so the
+        rules are loaded from the snapshot when there is one and only the
+        messages written to file since are trained on, by this model and the
+        shared one alike.
+
+        The model is made ready even if loading fails, with whatever rules
+        it got that far, so the room isn't left warming up and the lines
+        that waited are still written. The error is raised after.
+        """
+        try:
+            with_shared = self.shared is not None
+            if with_shared and not self.shared.ready.wait(SHARED_WAIT):
+                print('The shared Markov model is taking long to load, so {room} is loading without it'.format(
+                      room = self.room_name))
+                with_shared = False
+            # lines for this room still waiting to be written would be missed
+            corpus_writer.flush()
+            loaded = self.loadSnapshot()
+            if self.file_name:
+                self.catchUp(with_shared)
+                if self.unsaved and (not loaded or self.unsaved >= SNAPSHOT_MIN_TAIL):
+                    self.saveSnapshot()
+                if with_shared and self.shared.unsaved >= SNAPSHOT_MIN_TAIL:
+                    self.shared.saveSnapshot()
+        finally:
+            with self.lock:
+                self.ready.set()
+                waiting, self.waiting = self.waiting, []
+                for msg in waiting:
+                    self.updateDatabase(msg, True)
+            if self.file_name:
+                sentence_maker.add(self)
 
+    def loadDone(self, future):
+        if future.exception() is not None:
+            print('Loading the Markov model for {room} failed: {error}'.format(
+                  room = self.room_name, error = future.exception()))
 
-    def getFromFile(self):
-        """Gets information from the database.
+    def catchUp(self, with_shared = True):
+        """Trains this model and the shared one on the lines of the text file
+        they haven't seen yet.
+
+        The offsets move on with every line, so they stay right if reading
+        the file fails halfway.
+        Args:
+            with_shared: Bool, if the shared model is trained too.
+        """
+        stores = [self] if self.shared is None or not with_shared else [self, self.shared]
+        offsets = [store.files.get(self.file_name, 0) for store in stores]
+        start = min(offsets)
+        for end, msg in self.getFromFile(start):
+            msg = ' '.join(msg).strip()
+            for store, offset in zip(stores, offsets):
+                if start >= offset:
+                    with store.lock:
+                        store.train(msg)
+                        store.unsaved += end - start
+                        store.files[self.file_name] = end
+                    # this runs on a loader thread, so it can prune right
+                    # away rather than let a long file run far over budget
+                    if store.size() > store.budget:
+                        store.prune()
+            start = end
+
+    def loadSnapshot(self):
+        """Loads the rules saved by saveSnapshot.
+
+        The snapshot is skipped if it was made by another version of this
+        file, or if any text file is no longer the one it was made from.
+        Returns:
+            Bool, if the snapshot was loaded.
+        """
+        try:
+            with open(self.snapshot_name, 'rb') as snapshot:
+                if snapshot.readline() != SNAPSHOT_HEADER:
+                    return False
+                data = pickle.load(snapshot)
+            for file_name, (offset, head) in data['files'].items():
+                if (os.path.getsize(file_name) < offset or
+                        corpusHead(file_name, offset) != head):
+                    return False
+        except (OSError, EOFError, KeyError, ValueError, TypeError, pickle.UnpicklingError):
+            return False
+        # the vocabulary's sweep has to see the cache once its words have ids
+        with self.lock:
+            self.files = {file_name: offset for file_name, (offset, head) in data['files'].items()}
+            self.cache = self.adoptWords(data['words'], data['cache'])
+            self.positions = {}
+            self.buildIndex()
+            self.array_bytes = sum(ARRAY_BYTES + successors.itemsize * len(successors)
+                                   for successors in self.cache.values() if isinstance(successors, array))
+        return True
+
+    def adoptWords(self, words, cache):
+        """Returns the rules of a snapshot with the ids the vocabulary gives
+        their words.
+
+        The vocabulary is shared by every model, so the ids a snapshot was
+        saved with are usually still the same, or free for its words to take.
+        Only a snapshot from another run numbering its words some other way
+        has to be gone through.
+        """
+        if self.vocabulary.claim(words):
+            return cache
+        ids = [None if word is None else self.vocabulary.id(word) for word in words]
+        adopted = {}
+        for key, successors in cache.items():
+            key = packKey(ids[key >> 64], ids[(key >> 32) & 0xffffffff], ids[key & 0xffffffff])
+            if isinstance(successors, array):
+                count = len(successors) // 2
+                successors[:count] = array('I', [ids[word] for word in successors[:count]])
+            else:
+                successors = (ids[successors >> 32] << 32) | (successors & 0xffffffff)
+            adopted[key] = successors
+        return adopted
+
+    def saveSnapshot(self):
+        """Saves the rules trained on the text files so far."""
+        with self.lock:
+            # the lines trained on have to be in the files for the offsets
+            # to be right
+            corpus_writer.flush()
+            # models loading alongside may be adding words while this is saved
+            writeSnapshot(self.snapshot_name, self.files, list(self.vocabulary.words), self.cache)
+            self.unsaved = 0
+
+    def getFromFile(self, offset = 0):
+        """Gets information from the database, from offset on.
         Yields:
+            int, where the line ends in the file.
             list of str, a list of the sentences that were mentioned in chat.
-        Raises:
-            FileException: no file found.
         """
-        open_file = open(self.file_name, 'r') 
-        for line in open_file:
-            # we're removing periods to avoid a possible infinite loop in our
-            # rules
-            line = line.strip().split(' ')
-            yield line        
-        open_file.close()
+        if not os.path.exists(self.file_name):
+            return
+        with open(self.file_name, 'rb') as open_file:
+            open_file.seek(offset)
+            for line in open_file:
+                # A line without its newline is still being written, and will
+                # be read in full next time
+                if not line.endswith(b'\n'):
+                    break
+                offset += len(line)
+                # we're removing periods to avoid a possible infinite loop in our
+                # rules
+                yield offset, line.decode('utf-8', 'replace').strip().split(' ')
 
     def putToFile(self, msg):
-        """Writes information from the database to file."""
-        open_file = open(self.file_name, 'a') 
-        open_file.write(msg + '\n' if '\n' not in msg else '')
-        open_file.close()
+        """Writes information from the database to file, see CorpusWriter.
+        Returns:
+            int, how many bytes the file grows by.
+        """
+        if '\n' in msg:
+            return 0
+        line = msg + '\n'
+        corpus_writer.write(self.file_name, line)
+        return len(line.encode('utf-8'))
 
-    def getQuads(self, new_words):
+    @staticmethod
+    def getQuads(new_words, edge = ' '):
         """Returns a list of quadrupalets generated from the sentence.
         Args:
             new_words: string, sentence that tuples will be generated from.
+            edge: what stands for the whitespace around the sentence.
         Yields:
             list of string quadrupalets. 
         """
@@ -92,16 +675,16 @@ class Markov(object):
         else:
             # we will map the beginning of an arbitrary sentence ('.', '.') to
             # the start of an actual sentence 
-            yield (' ', ' ', ' ', new_words[0]) 
-            yield (' ', ' ', new_words[0], new_words[1])
-            yield (' ', new_words[0], new_words[1], new_words[2])
+            yield (edge, edge, edge, new_words[0]) 
+            yield (edge, edge, new_words[0], new_words[1])
+            yield (edge, new_words[0], new_words[1], new_words[2])
             for i in range(len(new_words)-3):
                 yield (new_words[i], new_words[i+1], new_words[i+2], new_words[i+3])
             # we will map the end of a word to a end of sentence, then the end
             # of a sentence to the start of an arbitrary sentence
-            yield (new_words[-3], new_words[-2], new_words[-1], ' ')
-            yield (new_words[-2], new_words[-1], ' ', ' ')
-            yield (new_words[-1], ' ', ' ', ' ')
+            yield (new_words[-3], new_words[-2], new_words[-1], edge)
+            yield (new_words[-2], new_words[-1], edge, edge)
+            yield (new_words[-1], edge, edge, edge)
 
     def updateDatabase(self, msg, new_msg=False):
         """ Adds a word to the database and writes it to file.
@@ -124,65 +707,399 @@ class Markov(object):
         """
         # record the entries in our database 
         # if it isn't already
-        if new_msg:
-            self.putToFile(msg)
+        if not self.ready.is_set():
+            with self.lock:
+                # load sets ready while holding the lock, then goes through
+                # the lines that waited
+                if not self.ready.is_set():
+                    if new_msg:
+                        self.waiting.append(msg)
+                    return
+        written = self.putToFile(msg) if new_msg else 0
+        with self.lock:
+            self.train(msg)
+            if self.size() > self.budget:
+                sentence_maker.prune(self)
+            self.stale_lines += 1
+            if self.stale_lines >= POOL_STALE_LINES:
+                # the sentences were made before what was said since
+                self.pool.clear()
+                self.stale_lines = 0
+                sentence_maker.notify()
+            if written:
+                self.files[self.file_name] = self.files.get(self.file_name, 0) + written
+        # a room that gave up waiting on the shared model mustn't train it
+        # while it loads
+        if self.shared is not None and self.shared.ready.is_set():
+            with self.shared.lock:
+                self.shared.train(msg)
+                if self.shared.size() > self.shared.budget:
+                    sentence_maker.prune(self.shared)
+                if written:
+                    self.shared.files[self.file_name] = self.shared.files.get(self.file_name, 0) + written
+
+    def train(self, msg):
         # Parse the message and add it into the database
-        for w1, w2, w3, w4 in self.getQuads(msg.strip().split(' ')):
-            key = (w1, w2, w3)
-            if key in self.cache and w4 in self.cache[key]:
-                self.cache[key][w4] += 1
-                self.cache_len[key] += 1
-            elif key in self.cache and w4 not in self.cache[key]: 
-                self.cache[key][w4] = 1
-                self.cache_len[key] += 1
+        word_ids = [self.vocabulary.id(word) for word in msg.strip().split(' ')]
+        for w1, w2, w3, w4 in self.getQuads(word_ids, EDGE):
+            # packKey, spelled out as this runs for every word trained on
+            key = (w1 << 64) | (w2 << 32) | w3
+            self.samplers.pop(key, None)
+            successors = self.cache.get(key)
+            if successors is None:
+                self.cache[key] = (w4 << 32) | 1
+                if w2 != EDGE:
+                    self.index.setdefault(w2, []).append(key)
+            elif not isinstance(successors, array):
+                if successors >> 32 == w4:
+                    self.cache[key] = successors + 1
+                else:
+                    self.cache[key] = array('I', (successors >> 32, w4, successors & 0xffffffff, 1))
+                    self.array_bytes += ARRAY_BYTES + 16
             else:
-                self.cache[key] = {}
-                self.cache[key][w4] = 1
-                self.cache_len[key] = 1
+                words = len(successors) // 2
+                positions = self.positions.get(key)
+                if positions is None and words >= SAMPLER_MIN_WORDS:
+                    positions = self.positions[key] = {word: i for i, word in enumerate(successors[:words])}
+                if positions is not None:
+                    i = positions.get(w4, words)
+                else:
+                    # the counts come after the words, so if the id is only
+                    # found among them the word is new
+                    try:
+                        i = successors.index(w4)
+                    except ValueError:
+                        i = words
+                if i < words:
+                    successors[words + i] += 1
+                else:
+                    successors.insert(words, w4)
+                    successors.append(1)
+                    self.array_bytes += 8
+                    if positions is not None:
+                        positions[w4] = words
+
+    def size(self):
+        """Returns roughly how many bytes the rules take."""
+        return len(self.cache) * KEY_BYTES + self.array_bytes
+
+    def prune(self):
+        """Drops the rarest keys until the model is well under its budget.
+
+        Most keys were only seen once or twice, so dropping those frees most
+        of the memory while keeping the common ways sentences go. Generating
+        text ends a sentence where it reaches a dropped key.
+
+        This runs on the thread of sentence_maker or a loader, not the one
+        receiving messages. The keys to drop are picked without holding the
+        lock and dropped PRUNE_BATCH at a time, so training only waits on
+        the lock for a moment. Keys seen again in the meantime are kept.
+        """
+        start = packKey(EDGE, EDGE, EDGE)
+        if self.size() <= self.budget:
+            return
+        # bytes freed by dropping the keys seen a given number of times
+        freed = {}
+        for key, successors in self.items():
+            if key != start:
+                total = self.total(successors)
+                size = KEY_BYTES
+                if isinstance(successors, array):
+                    size += ARRAY_BYTES + successors.itemsize * len(successors)
+                freed[total] = freed.get(total, 0) + size
+        excess = self.size() - self.budget * PRUNE_TARGET
+        threshold = 0
+        for total in sorted(freed):
+            if excess <= 0:
+                break
+            threshold = total
+            excess -= freed[total]
+        doomed = {}
+        for key, successors in self.items():
+            if key != start and self.total(successors) <= threshold:
+                doomed.setdefault((key >> 32) & 0xffffffff, []).append(key)
+        dropped = 0
+        batch, size = [], 0
+        while doomed:
+            # popping lets the keys go a few at a time rather than all at
+            # the end, which would hold up every thread
+            word, keys = doomed.popitem()
+            for i in range(0, len(keys), PRUNE_BATCH):
+                batch.append((word, keys[i:i + PRUNE_BATCH]))
+                size += len(batch[-1][1])
+                if size >= PRUNE_BATCH:
+                    dropped += self.dropKeys(batch, threshold)
+                    batch, size = [], 0
+        dropped += self.dropKeys(batch, threshold)
+        with self.lock:
+            self.prunes += 1
+            self.pruned += dropped
+        print('Pruned {keys} rules seen at most {times} times from the Markov model for {room}'.format(
+              keys = dropped, times = threshold, room = self.room_name))
+
+    def dropKeys(self, batch, threshold):
+        """Drops keys seen at most threshold times from the cache and index.
+
+        Args:
+            batch: list of (word, keys) pairs, the keys to drop by the word
+                   in their middle.
+            threshold: int, keys seen more often since they were picked are
+                       kept.
+        Returns:
+            int, how many keys were dropped.
+        """
+        dropped = 0
+        with self.lock:
+            for word, keys in batch:
+                gone = set()
+                for key in keys:
+                    successors = self.cache.get(key)
+                    if successors is None or self.total(successors) > threshold:
+                        continue
+                    del self.cache[key]
+                    if isinstance(successors, array):
+                        self.array_bytes -= ARRAY_BYTES + successors.itemsize * len(successors)
+                    self.positions.pop(key, None)
+                    self.samplers.pop(key, None)
+                    gone.add(key)
+                if gone and word in self.index:
+                    kept = [key for key in self.index[word] if key not in gone]
+                    if kept:
+                        self.index[word] = kept
+                    else:
+                        del self.index[word]
+                dropped += len(gone)
+        return dropped
 
+    def items(self):
+        """Yields the (key, successors) pairs of the cache.
+
+        Only the keys are copied while holding the lock, so this can go
+        through the cache while training goes on. Keys dropped in the
+        meantime are skipped, and ones added are left out.
+        """
+        with self.lock:
+            keys = list(self.cache)
+        for key in keys:
+            successors = self.cache.get(key)
+            if successors is not None:
+                yield key, successors
+
+    def buildIndex(self):
+        """Indexes every key of the cache by the word in its middle.
+
+        A key is only indexed by its middle word as every word said is in the
+        middle of one, and it is the one choosePrevious looks keys up by.
+        """
+        index = {}
+        for key in self.cache:
+            word = (key >> 32) & 0xffffffff
+            if word != EDGE:
+                index.setdefault(word, []).append(key)
+        self.index = index
+
+    def total(self, successors):
+        """Returns how many times the words in a cache entry were seen."""
+        if not isinstance(successors, array):
+            return successors & 0xffffffff
+        return sum(successors[len(successors) // 2:])
+
+    def stats(self):
+        """Returns a summary of the size of the model and its pruning."""
+        summary = ('{keys} rules, about {size:.1f}MB of {budget:.1f}MB. '
+                   'Pruned {prunes} times, dropping {pruned} rules.').format(
+                   keys = len(self.cache), size = self.size() / 2**20,
+                   budget = self.budget / 2**20, prunes = self.prunes,
+                   pruned = self.pruned)
+        if self.shared is None:
+            return summary
+        return 'Room: {room} Shared: {shared} {words} words in all.'.format(
+               room = summary, shared = self.shared.stats(),
+               words = len(self.vocabulary.ids))
 
     def chooseWord(self, key):
         """Chooses a word based from the cache list.
 
-        Chooses a word uniformly by taking into account the probability of each
-        word occuring.
-        
         Args:
             key: string tuple, the key word we want to chose a word from.
         """
-        seed = random.randint(0, self.cache_len[key]-1)
+        ids = self.vocabulary.ids
+        return self.vocabulary.words[self.chooseId(packKey(ids[key[0]], ids[key[1]], ids[key[2]]))]
+
+    def chooseId(self, key):
+        """Chooses the id of a word to follow a packed key.
+
+        Chooses a word uniformly by taking into account the probability of each
+        word occuring. Walking through every word after a common tuple is slow,
+        so for those the running totals of the counts are kept and searched
+        instead.
+
+        The room's own rules are mixed with the shared ones by weight, so
+        thin rooms mostly talk like everyone else and busy ones like
+        themselves. Where only one of the models has the key, that one is
+        used.
+        """
+        successors = self.cache.get(key)
+        if (self.shared is not None and key in self.shared.cache and
+                (successors is None or random.random() >= self.weight)):
+            return self.shared.chooseId(key)
+        if successors is None:
+            # pruned away, so end the sentence here
+            return EDGE
+        if not isinstance(successors, array):
+            return successors >> 32
+        words = len(successors) // 2
+        if words < SAMPLER_MIN_WORDS:
+            # the first word whose running total passes the seed gets picked
+            seed = random.randint(0, sum(successors[words:])-1)
+            tot = 0
+            for i in range(words):
+                tot += successors[words + i]
+                if tot > seed:
+                    return successors[i]
+        if key not in self.samplers:
+            self.samplers[key] = (successors[:words], list(accumulate(successors[words:])))
+        words, totals = self.samplers[key]
+        seed = random.randint(0, totals[-1]-1)
+        return words[bisect.bisect_right(totals, seed)]
+
+    def chooseSeed(self, word):
+        """Chooses a key with a word id in the middle, or None if the word
+        was never said. Mixes the room's rules with the shared ones like
+        chooseId.
+        """
+        keys = self.index.get(word)
+        if self.shared is not None:
+            common = self.shared.index.get(word)
+            if common and (not keys or random.random() >= self.weight):
+                keys = common
+        return random.choice(keys) if keys else None
+
+    def predecessors(self, w1, w2, w3):
+        """Returns the ids of the words seen before w1 and w2 where those were
+        followed by w3, with how often they were.
+        """
+        options = []
+        for key in self.index.get(w1, ()):
+            if key & 0xffffffff != w2:
+                continue
+            successors = self.cache[key]
+            if not isinstance(successors, array):
+                if successors >> 32 == w3:
+                    options.append((key >> 64, successors & 0xffffffff))
+                continue
+            words = len(successors) // 2
+            try:
+                i = successors.index(w3)
+            except ValueError:
+                continue
+            if i < words:
+                options.append((key >> 64, successors[words + i]))
+        return options
+
+    def choosePrevious(self, w1, w2, w3):
+        """Chooses the id of a word to come before three others, like chooseId
+        does for the word after them.
+
+        The keys that could come before are found in the index of the first
+        word, so this takes longer the more keys that word is in. Returns
+        EDGE when the three words start a sentence.
+        """
+        options = self.predecessors(w1, w2, w3)
+        if self.shared is not None:
+            common = self.shared.predecessors(w1, w2, w3)
+            if common and (not options or random.random() >= self.weight):
+                options = common
+        if not options:
+            return EDGE
+        seed = random.randint(0, sum(count for word, count in options)-1)
         tot = 0
-        for i in self.cache[key]:
-            tot += self.cache[key][i]
-            if tot >= seed:
-                return i
-        # just return a random element in case I messed up
-        return next (iter (self.cache[key].values()))
+        for word, count in options:
+            tot += count
+            if tot > seed:
+                return word
 
+    def takeSentence(self):
+        """Returns a sentence from the pool, or a new one if it's empty."""
+        try:
+            sentence = self.pool.popleft()
+        except IndexError:
+            sentence = self.generateText()
+        sentence_maker.notify()
+        return sentence
 
+    def fillPool(self):
+        """Adds one sentence to the pool."""
+        # holding the lock throughout keeps a sentence made before the pool
+        # went stale from being added after
+        with self.lock, self.sharedLock():
+            if len(self.pool) < POOL_SIZE:
+                self.pool.append(self.walk(MAX_STEPS))
 
-    def generateText(self, size=20):
+    def generateText(self, size=20, max_steps=MAX_STEPS):
         """Generates a sentence using the rules set we have defined 
 
         Args:
             size: int, the amount of words that we would like to generate
+            max_steps: int, the most words to generate before stopping.
         Return:
             string, generated using Markov chains and the rules defined.
         Raise:
             None.
         """
+        with self.lock, self.sharedLock():
+            return self.walk(max_steps)
+
+    def generateAbout(self, word, max_steps=MAX_STEPS):
+        """Generates a sentence with a word in it.
+
+        The sentence is walked backward from a key with the word in it to
+        where a sentence starts, and forward to where one ends.
+        Args:
+            word: string, the word to talk about.
+            max_steps: int, the most words to generate each way.
+        Return:
+            string, the sentence, or None if the word was never said.
+        """
+        with self.lock, self.sharedLock():
+            word_id = self.vocabulary.ids.get(word)
+            if word_id is None:
+                return None
+            key = self.chooseSeed(word_id)
+            if key is None:
+                return None
+            before = deque((key >> 64, (key >> 32) & 0xffffffff, key & 0xffffffff))
+            for _ in range(max_steps):
+                if before[0] == EDGE:
+                    break
+                before.appendleft(self.choosePrevious(before[0], before[1], before[2]))
+            gen_ids = list(before)
+            for _ in range(max_steps):
+                if gen_ids[-1] == EDGE:
+                    break
+                gen_ids.append(self.chooseId(packKey(gen_ids[-3], gen_ids[-2], gen_ids[-1])))
+        return ' '.join(self.vocabulary.words[word_id] for word_id in gen_ids if word_id != EDGE)
+
+    def sharedLock(self):
+        """Returns the lock to hold while reading the shared rules."""
+        # the own lock is reentrant, so taking it twice does no harm
+        return self.lock if self.shared is None else self.shared.lock
+
+    def walk(self, max_steps):
         # we will start the seed at with words listed under the arbitrary
         # sentence
-        seed_word, mid_word, next_word = ' ', ' ', self.chooseWord((' ',' ',' '))
+        seed_word, mid_word, next_word = EDGE, EDGE, self.chooseId(packKey(EDGE, EDGE, EDGE))
         w1, w2, w3 = seed_word, mid_word, next_word
         gen_words = []
         # we'll skip printing the beginning
         sen_cnt = 2 
-        while sen_cnt >= 0: 
-            if w1 != ' ':
-                gen_words.append(w1)
-            w1, w2, w3 = w2, w3, self.chooseWord((w1, w2, w3)) 
-            if (w1, w2, w3) == (' ',' ',' '):
+        steps = 0
+        while sen_cnt >= 0 and steps < max_steps:
+            steps += 1
+            if w1 != EDGE:
+                gen_words.append(self.vocabulary.words[w1])
+            w1, w2, w3 = w2, w3, self.chooseId(packKey(w1, w2, w3))
+            if (w1, w2, w3) == (EDGE, EDGE, EDGE):
                 sen_cnt -= 1
         return ' '.join(gen_words)
 
@@ -0,0 +1,186 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 William Granados
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Trains the Markov models of rooms from their text files on every core, and
+# writes the snapshots the bot loads on joining, so a years-long archive
+# doesn't have to be replayed line by line when the bot starts.
+#
+# Usage (from the folder app.py is in):
+#   python3 -m plugins.math.markovtrain [-j jobs] roomdata-room.txt...
+#
+# The files are split into shards, each process counts the quads of its
+# shards, and the counts are merged in file order. That numbers the words and
+# orders the rules just like a single process training on the files one line
+# after another would, so the snapshots come out the same. The snapshots
+# aren't pruned; the bot prunes a model to its budget once it trains on it.
+
+import argparse
+from collections import OrderedDict
+from multiprocessing import Pool
+import os
+import time
+
+from plugins.math.markov import EDGE, Markov, Vocabulary, packKey, packSuccessors, writeSnapshot
+
+# Shards are cut at the first line end after this many bytes
+SHARD_BYTES = 8 << 20
+
+
+def shardFile(file_name):
+    """Returns the (file_name, start, end) shards a text file splits into."""
+    shards = []
+    size = os.path.getsize(file_name)
+    with open(file_name, 'rb') as open_file:
+        start = 0
+        while start < size:
+            open_file.seek(start + SHARD_BYTES)
+            open_file.readline()
+            end = min(open_file.tell(), size)
+            shards.append((file_name, start, end))
+            start = end
+    return shards
+
+
+def countShard(shard):
+    """Counts the quads in the lines of a shard.
+
+    Returns:
+        string, the file the shard is in.
+        int, where the last complete line of the shard ends.
+        list of str, the words of the shard in the order they were first seen,
+        their index being the ids the counts use.
+        dict, maps a packed key shifted left by 32 plus the id of the word
+        after it to how often it was seen, in the order they were first seen.
+        int, how many words the shard has.
+    """
+    file_name, offset, end = shard
+    vocabulary = Vocabulary()
+    counts = {}
+    words = 0
+    with open(file_name, 'rb') as open_file:
+        open_file.seek(offset)
+        while offset < end:
+            line = open_file.readline()
+            # Markov.getFromFile leaves out an unfinished last line as well
+            if not line.endswith(b'\n'):
+                break
+            offset += len(line)
+            word_ids = [vocabulary.id(word) for word in line.decode('utf-8', 'replace').strip().split(' ')]
+            words += len(word_ids)
+            for w1, w2, w3, w4 in Markov.getQuads(word_ids, EDGE):
+                quad = (packKey(w1, w2, w3) << 32) | w4
+                counts[quad] = counts.get(quad, 0) + 1
+    return file_name, offset, vocabulary.words, counts, words
+
+
+def mergeCounts(entries, key, word, count):
+    """Adds to how often a word followed a key.
+
+    Like in Markov.cache, a key followed by one word has an int of the word
+    shifted left by 32 plus its count, and the others a map of words to
+    counts, which packSuccessors turns into the array the cache has.
+    """
+    entry = entries.get(key)
+    if entry is None:
+        entries[key] = (word << 32) | count
+    elif isinstance(entry, int):
+        if entry >> 32 == word:
+            entries[key] = entry + count
+        else:
+            entries[key] = {entry >> 32: entry & 0xffffffff, word: count}
+    else:
+        entry[word] = entry.get(word, 0) + count
+
+
+def successorCounts(entry):
+    """Returns the words and counts of an entry made by mergeCounts."""
+    if isinstance(entry, int):
+        return ((entry >> 32, entry & 0xffffffff),)
+    return entry.items()
+
+
+def finishRoom(file_name, offset, words, entries, shared):
+    """Writes the snapshot of a room and adds its rules to the shared ones."""
+    cache = {}
+    for key, entry in entries.items():
+        cache[key] = entry if isinstance(entry, int) else packSuccessors(entry)
+        for word, count in successorCounts(entry):
+            mergeCounts(shared, key, word, count)
+    writeSnapshot(os.path.splitext(file_name)[0] + '.markov', {file_name: offset},
+                  words, cache)
+    return len(cache)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Train the Markov models '
+                                     'of rooms from their text files.')
+    parser.add_argument('files', nargs = '+',
+                        help = 'text files of the rooms, named like the bot names them')
+    parser.add_argument('-s', '--shared', default = 'roomdata-global.markov',
+                        help = 'where to write the snapshot of the model shared by the rooms')
+    parser.add_argument('-j', '--jobs', type = int, default = os.cpu_count(),
+                        help = 'number of processes counting quads')
+    args = parser.parse_args()
+    files = list(OrderedDict.fromkeys(args.files))
+
+    start = time.perf_counter()
+    shards = [shard for file_name in files for shard in shardFile(file_name)]
+    total_bytes = sum(os.path.getsize(file_name) for file_name in files)
+    vocabulary = Vocabulary()
+    shared, offsets = {}, {}
+    entries, current = {}, None
+    done_bytes = words = 0
+    with Pool(args.jobs) as pool:
+        # imap hands the shards back in order, which keeps the ids and the
+        # order of the rules the same as training on the lines in turn
+        for (_, shard_start, shard_end), result in zip(shards, pool.imap(countShard, shards)):
+            file_name, offset, shard_words, counts, shard_word_count = result
+            if file_name != current:
+                if current is not None:
+                    finishRoom(current, offsets[current], list(vocabulary.words), entries, shared)
+                entries, current = {}, file_name
+            ids = [vocabulary.id(word) for word in shard_words]
+            for quad, count in counts.items():
+                key = quad >> 32
+                key = packKey(ids[key >> 64], ids[(key >> 32) & 0xffffffff], ids[key & 0xffffffff])
+                mergeCounts(entries, key, ids[quad & 0xffffffff], count)
+            offsets[file_name] = offset
+            done_bytes += shard_end - shard_start
+            words += shard_word_count
+            print('{done:.0f}/{total:.0f}MB, {words} words, {rate:.0f} words/s'.format(
+                  done = done_bytes / 2**20, total = total_bytes / 2**20, words = words,
+                  rate = words / (time.perf_counter() - start)), end = '\r')
+        if current is not None:
+            finishRoom(current, offsets[current], list(vocabulary.words), entries, shared)
+    cache = {key: entry if isinstance(entry, int) else packSuccessors(entry)
+             for key, entry in shared.items()}
+    writeSnapshot(args.shared, offsets, vocabulary.words, cache)
+    wall = time.perf_counter() - start
+    print()
+    print('Trained on {n} files in {wall:.1f}s, {words} words at {rate:.0f} words/s, '
+          '{keys} shared rules over {vocab} words'.format(
+          n = len(files), wall = wall, words = words, rate = words / wall,
+          keys = len(cache), vocab = len(vocabulary.words)))
+
+
+if __name__ == '__main__':
+    main()
@@ -20,9 +20,13 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import atexit
 from datetime import datetime, timedelta
-import random
 import re
+from threading import Lock
+import time
+
+from plugins.statestore import openDatabase
 
 class Message:
     def __init__(self, sent, msg):
@@ -32,44 +36,89 @@ class Message:
         return 'From {user}: {msg}'.format(user = self.sent, msg = self.msg)
 
 class MessageDatabase:
+    """Keeps the messages left with ~tell until their recipient reads them.
+
+    The messages are kept in a SQLite database in WAL mode, so they survive
+    the bot restarting. Which users have messages waiting is also kept in a
+    set, as that is checked for everyone joining a room and shouldn't have to
+    go to the database.
+
+    Attributes:
+        path: string, path of the database file.
+        recipients: set of the ids of users with messages waiting.
+        lastNotification: maps user ids to when they were last told they have
+                          messages waiting.
+    """
     # Constant
     def NOTIFICATION_GAP(self): return timedelta(hours = 1)
-
-    def __init__(self):
-        self.messages = {}
+    # Most messages one ~read shows, a long list of them is spammy
+    def READ_LIMIT(self): return 10
+    # Messages nobody read for this long are deleted, checking at most once
+    # every EXPIRY_INTERVAL
+    def EXPIRY(self): return timedelta(days = 60)
+    def EXPIRY_INTERVAL(self): return timedelta(hours = 1)
+
+    def __init__(self, path = 'plugins/messages.db'):
+        self.path = path
+        # Only this process uses the database, so holding the lock is enough
+        # to keep reading and deleting messages from interleaving
+        self.lock = Lock()
+        self.db = openDatabase(path)
+        # The primary key doubles as the index of the messages to a user
+        self.db.execute('CREATE TABLE IF NOT EXISTS messages (recipient TEXT, sender TEXT, '
+                        'name TEXT, msg TEXT, sent REAL, PRIMARY KEY (recipient, sender))')
+        self.db.execute('CREATE INDEX IF NOT EXISTS messages_sent ON messages (sent)')
         self.lastNotification = {}
+        self.nextExpiry = 0
+        self.expireMessages()
+        atexit.register(self.close)
+
+    def loadRecipients(self):
+        self.recipients = {row[0] for row in self.db.execute('SELECT DISTINCT recipient FROM messages')}
+
+    def expireMessages(self):
+        now = time.time()
+        if now < self.nextExpiry:
+            return
+        self.nextExpiry = now + self.EXPIRY_INTERVAL().total_seconds()
+        with self.lock:
+            self.db.execute('DELETE FROM messages WHERE sent < ?', (now - self.EXPIRY().total_seconds(),))
+            self.loadRecipients()
 
     def pendingMessages(self, user):
-        cnt = len(self.messages[user])
+        with self.lock:
+            cnt = self.db.execute('SELECT count(*) FROM messages WHERE recipient = ?', (user,)).fetchone()[0]
         return 'You have {nr} message{s} waiting for you.\nUse ~read [number] to get [number] of messages shown to you'.format(nr = cnt, s = 's' if cnt > 1 else '')
     def addMessage(self, to, sent, msg):
-        if to not in self.messages: self.messages[to] = {}
+        self.expireMessages()
         # Set last notification to something far in the past so it triggers the first time always
         if to not in self.lastNotification: self.lastNotification[to] = datetime(2015, 1, 1)
-        if sent in self.messages[to]: return False
-
-        self.messages[to][re.sub(r'[^a-zA-z0-9,]', '', sent).lower()] = Message(sent, msg)
-        return True
+        with self.lock:
+            added = self.db.execute('INSERT OR IGNORE INTO messages VALUES (?, ?, ?, ?, ?)',
+                                    (to, re.sub(r'[^a-zA-z0-9,]', '', sent).lower(), sent, msg, time.time())).rowcount
+            self.recipients.add(to)
+        return added > 0
 
     def getMessage(self, user):
-        return self.removeRandomMessage(user).replyFormat()
+        return self.getMessages(user, 1)
 
     def getMessages(self, user, amnt):
-        ''' This removes amnt number of messages from the message service '''
+        ''' This removes amnt number of messages from the message service, oldest first '''
 
         # This can be super-spammy for users with a lot of pending messages
         # as they can opt to look at all at once
-        reply = ''
-        if amnt > len(self.messages[user]): amnt = len(self.messages[user])
-        while amnt > 0:
-            reply += self.getMessage(user) + ('\n' if amnt > 1 else '')
-            amnt -= 1
-        # Remove the user from the list if there's no messages left
-        # and clear the last notification time
-        if not self.messages[user]:
-            self.messages.pop(user)
-            self.lastNotification.pop(user)
-        return reply
+        amnt = min(amnt, self.READ_LIMIT())
+        with self.lock:
+            rows = self.db.execute('SELECT rowid, name, msg FROM messages WHERE recipient = ? '
+                                   'ORDER BY sent LIMIT ?', (user, amnt)).fetchall()
+            self.db.executemany('DELETE FROM messages WHERE rowid = ?', [(row[0],) for row in rows])
+            left = self.db.execute('SELECT 1 FROM messages WHERE recipient = ? LIMIT 1', (user,)).fetchone()
+            # Remove the user from the list if there's no messages left
+            # and clear the last notification time
+            if left is None:
+                self.recipients.discard(user)
+                self.lastNotification.pop(user, None)
+        return '\n'.join(Message(name, msg).replyFormat() for _, name, msg in rows)
 
     def getAllMessages(self, user):
         ''' This gets and delete every message to this user from storage '''
@@ -77,36 +126,51 @@ class MessageDatabase:
         # No need to test for existance, this assumes a message exists
         # and usage should first test for existance.
         messages = self.removeAllMessages(user)
-        combine = []
-        for msg in messages:
-            combine.append(messages[msg].replyFormat())
-        return '\n'.join(combine)
+        return '\n'.join(message.replyFormat() for message in messages)
 
     def shouldNotifyMessage(self, user):
         if self.hasMessage(user):
             now = datetime.now()
-            if now - self.lastNotification[user] > self.NOTIFICATION_GAP():
+            if now - self.lastNotification.get(user, datetime(2015, 1, 1)) > self.NOTIFICATION_GAP():
                 self.lastNotification[user] = now
                 return True
         return False
 
     def hasMessage(self, user):
-        return user in self.messages
+        return user in self.recipients
 
     def alreadySentMessage(self, user, frm):
-        return user in self.messages and frm in self.messages[user]
+        if not self.hasMessage(user):
+            return False
+        with self.lock:
+            return self.db.execute('SELECT 1 FROM messages WHERE recipient = ? AND sender = ?',
+                                   (user, frm)).fetchone() is not None
 
-    def removeRandomMessage(self, to):
-        return self.messages[to].pop(random.choice(list(self.messages[to].keys())), None)
     def removeMessage(self, to, frm):
-        msg = self.messages[to].pop(frm, None)
-        # If the user has no message left, clear the name entry
-        if len(self.messages[to]) < 1: self.messages.pop(to)
-        return msg
+        with self.lock:
+            row = self.db.execute('SELECT name, msg FROM messages WHERE recipient = ? AND sender = ?',
+                                  (to, frm)).fetchone()
+            self.db.execute('DELETE FROM messages WHERE recipient = ? AND sender = ?', (to, frm))
+            left = self.db.execute('SELECT 1 FROM messages WHERE recipient = ? LIMIT 1', (to,)).fetchone()
+            # If the user has no message left, clear the name entry
+            if left is None: self.recipients.discard(to)
+        return Message(*row) if row else None
 
     # Unused but still supported
     def removeAllMessages(self, to):
-        return self.messages.pop(to, None)
+        with self.lock:
+            rows = self.db.execute('SELECT name, msg FROM messages WHERE recipient = ? ORDER BY sent',
+                                   (to,)).fetchall()
+            self.db.execute('DELETE FROM messages WHERE recipient = ?', (to,))
+            self.recipients.discard(to)
+        return [Message(name, msg) for name, msg in rows]
+
+    def close(self):
+        if self.db is None:
+            return
+        with self.lock:
+            self.db.close()
+            self.db = None
 
 # Commands
 def tell(bot, cmd, room, msg, user):
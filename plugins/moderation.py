@@ -20,11 +20,24 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import hashlib
+import math
 import re
-from collections import deque
+import sys
+from array import array
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from urllib.request import urlopen
-import yaml
+from urllib.parse import urlsplit
+
+from plugins import stretching
+from plugins.domains import DomainIndex
+from plugins.journal import Journal
+from plugins.linkresolver import LinkResolver
+from plugins.ruleengine import Rule
+from plugins.ruleengine import RuleEngine
+from plugins.sketch import WindowedSketch
+from plugins.statestore import MemoryBackend
+from plugins.stretching import triggersStretching
 
 urlShorteners = ["spo.ink","goo.my","0rz.tw","1link.in","1url.com","2.gp","2big.at","2tu.us","3.ly","307.to","4ms.me","4sq.com","4url.cc","6url.com","7.ly","a.gg","a.nf","aa.cx","abcurl.net","ad.vu","adf.ly","adjix.com","afx.cc","all.fuseurl.com","alturl.com","amzn.to","ar.gy","arst.ch","atu.ca","azc.cc","b23.ru","b2l.me","bacn.me","bcool.bz","binged.it","bit.ly","bizj.us","bloat.me","bravo.ly","bsa.ly","budurl.com","canurl.com","chilp.it","chzb.gr","cl.lk","cl.ly","clck.ru","cli.gs","cliccami.info","clickthru.ca","clop.in","conta.cc","cort.as","cot.ag","crks.me","ctvr.us","cutt.us","dai.ly","decenturl.com","dfl8.me","digbig.com","digg.com","disq.us","dld.bz","dlvr.it","do.my","doiop.com","dopen.us","easyuri.com","easyurl.net","eepurl.com","eweri.com","fa.by","fav.me","fb.me","fbshare.me","ff.im","fff.to","fire.to","firsturl.de","firsturl.net","flic.kr","flq.us","fly2.ws","fon.gs","freak.to","fuseurl.com","fuzzy.to","fwd4.me","fwib.net","g.ro.lt","gizmo.do","gl.am","go.9nl.com","go.ign.com","go.usa.gov","goo.gl","goshrink.com","gurl.es","hex.io","hiderefer.com","hmm.ph","href.in","hsblinks.com","htxt.it","huff.to","hulu.com","hurl.me","hurl.ws","icanhaz.com","idek.net","ilix.in","is.gd","its.my","ix.lt","j.mp","jijr.com","kl.am","klck.me","korta.nu","krunchd.com","l9k.net","lat.ms","liip.to","liltext.com","linkbee.com","linkbun.ch","liurl.cn","ln-s.net","ln-s.ru","lnk.gd","lnk.ms","lnkd.in","lnkurl.com","lru.jp","lt.tl","lurl.no","macte.ch","mash.to","merky.de","migre.me","miniurl.com","minurl.fr","mke.me","moby.to","moourl.com","mrte.ch","myloc.me","myurl.in","n.pr","nbc.co","nblo.gs","nn.nf","not.my","notlong.com","nsfw.in","nutshellurl.com","nxy.in","nyti.ms","o-x.fr","oc1.us","om.ly","omf.gd","omoikane.net","on.cnn.com","on.mktw.net","onforb.es","orz.se","ow.ly","ping.fm","pli.gs","pnt.me","politi.co","post.ly","pp.gg","profile.to","ptiturl.com","pub.vitrue.com","qlnk.net","qte.me","qu.tc","qy.fi","r.im","rb6.me","read.bi","readthis.ca","reallytinyurl.com","redir.ec","redirects.ca","redirx.com","retwt.me","ri.ms","rickroll.it","riz.gd","rt.nu","ru.ly","rubyurl.com","rurl.org","rww.tw","s4c.in","s7y.us","safe.mn","sameurl.com","sdut.us","shar.es","shink.de","shorl.com","short.ie","short.to","shortlinks.co.uk","shorturl.com","shout.to","show.my","shrinkify.com","shrinkr.com","shrt.fr","shrt.st","shrten.com","shrunkin.com","simurl.com","slate.me","smallr.com","smsh.me","smurl.name","sn.im","snipr.com","snipurl.com","snurl.com","sp2.ro","spedr.com","srnk.net","srs.li","starturl.com","su.pr","surl.co.uk","surl.hu","t.cn","t.co","t.lh.com","ta.gd","tbd.ly","tcrn.ch","tgr.me","tgr.ph","tighturl.com","tiniuri.com","tiny.cc","tiny.ly","tiny.pl","tinylink.in","tinyuri.ca","tinyurl.com","tk.","tl.gd","tmi.me","tnij.org","tnw.to","tny.com","to.","to.ly","togoto.us","totc.us","toysr.us","tpm.ly","tr.im","tra.kz","trunc.it","twhub.com","twirl.at","twitclicks.com","twitterurl.net","twitterurl.org","twiturl.de","twurl.cc","twurl.nl","u.mavrev.com","u.nu","u76.org","ub0.cc","ulu.lu","updating.me","ur1.ca","url.az","url.co.uk","url.ie","url360.me","url4.eu","urlborg.com","urlbrief.com","urlcover.com","urlcut.com","urlenco.de","urli.nl","urls.im","urlshorteningservicefortwitter.com","urlx.ie","urlzen.com","usat.ly","use.my","vb.ly","vgn.am","vl.am","vm.lc","w55.de","wapo.st","wapurl.co.uk","wipi.es","wp.me","x.vu","xr.com","xrl.in","xrl.us","xurl.es","xurl.jp","y.ahoo.it","yatuc.com","ye.pe","yep.it","yfrog.com","yhoo.it","yiyd.com","youtu.be","yuarel.com","z0p.de","zi.ma","zi.mu","zipmyurl.com","zud.me","zurl.ws","zz.gd","zzang.kr"]
 whitelistedUrls = [
@@ -34,13 +47,122 @@ whitelistedUrls = [
     'puu.sh','i.imgur.com','prntscr.com','gyazo.com',
     'bulbapedia.bulbagarden.net','serebii.net'
     ]
+
+shortenerDomains = DomainIndex(urlShorteners)
+whitelistedDomains = DomainIndex(whitelistedUrls)
+linkResolver = LinkResolver()
+
 # Important regexes
 URL_REGEX = re.compile(r'\b(?:(?:(?:https?://|www[.])[a-z0-9\-]+(?:[.][a-z0-9\-]+)*|[a-z0-9\-]+(?:[.][a-z0-9\-]+)*[.](?:com?|org|net|edu|info|us|jp|[a-z]{2,3}(?=[:/])))(?:[:][0-9]+)?\b(?:/(?:(?:[^\s()<>]|[(][^\s()<>]*[)])*(?:[^\s`()<>\[\]{}\'".,!?;:]|[(][^\s()<>]*[)]))?)?|[a-z0-9.]+\b@[a-z0-9\-]+(?:[.][a-z0-9\-]+)*[.][a-z]{2,3})', flags = re.I)
-STRETCH_REGEX = re.compile(r'((.)\2{9,})|((..+)\4{5,})', flags = re.I)
+CAPS_REGEX = re.compile(r'[A-Z]')
+PUNCTUATION_REGEX = re.compile(r'[\W_]+')
 GROUP_REGEX = re.compile(r'(/groupchat-.+?-.+?\b)|(<<groupchat-.+?-.+?>>)', flags = re.I)
+# Something every link URL_REGEX matches has in it, and everything that can
+# come before the first of those in a link. Finding these is much cheaper
+# than running URL_REGEX at every position
+URL_HINT_REGEX = re.compile(r'://|www[.]|@|[.](?:com?|org|net|edu|info|us|jp|[a-z]{2,3}[:/])', flags = re.I)
+URL_LEAD_REGEX = re.compile(r'[a-z0-9.\-]*', flags = re.I)
+
+class FloodTracker:
+    """Remembers when users last talked, to tell if they are flooding a room.
+
+    Every user gets a ring buffer with room for MESSAGES_FOR_SPAM timestamps,
+    stored as integer milliseconds. Slot 0 of the buffer counts how many
+    messages were written so far.
+    Users in a room are kept in the order they last talked, so those idle
+    for longer than SPAM_INTERVAL are at the front and get dropped as new
+    messages come in. No room tracks more than MAX_TRACKED_USERS users.
+    """
+    def __init__(self):
+        self.rooms = {}
+
+    def trackedUsers(self, room = None):
+        if room is not None:
+            return len(self.rooms.get(room, ()))
+        return sum(len(users) for users in self.rooms.values())
+
+    def clear(self):
+        self.rooms.clear()
+
+    def lastTime(self, times):
+        return times[1 + (times[0] - 1) % (len(times) - 1)]
+
+    def add(self, room, userid, now):
+        """Records a message and returns the time of the message sent
+        MESSAGES_FOR_SPAM messages ago, counting this one, if there is one."""
+        users = self.rooms.setdefault(room, OrderedDict())
+        times = users.get(userid)
+        if times is None:
+            times = users[userid] = array('q', [0]) * (MESSAGES_FOR_SPAM() + 1)
+        else:
+            users.move_to_end(userid)
+        size = len(times) - 1
+        count = times[0] + 1
+        times[1 + (count - 1) % size] = now
+        times[0] = count
+        self.evict(users, now)
+        if count < size:
+            return None
+        return times[1 + count % size]
+
+    def evict(self, users, now):
+        idle = now - SPAM_INTERVAL() // timedelta(milliseconds = 1)
+        while users and self.lastTime(next(iter(users.values()))) < idle:
+            users.popitem(last = False)
+        while len(users) > MAX_TRACKED_USERS():
+            users.popitem(last = False)
+
+class PunishedUsers:
+    """Maps user ids to the PunishedUser holding their infraction points.
+
+    Points decay continuously and are only brought up to date when a user
+    is punished again. Users are stored as records in the state backend,
+    set to expire once their points will have decayed below
+    MIN_INFRACTION_SCORE, so only recent offenders are kept and every bot
+    process sharing the backend sees the same ones.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+
+    def __contains__(self, userid):
+        return self.backend.get('punished', userid) is not None
+
+    def __getitem__(self, userid):
+        punished = self.get(userid)
+        if punished is None:
+            raise KeyError(userid)
+        return punished
+
+    def get(self, userid):
+        record = self.backend.get('punished', userid)
+        return PunishedUser.fromRecord(userid, record) if record is not None else None
+
+    def __len__(self):
+        return self.backend.size('punished')
+
+    def punish(self, userid, points, now):
+        """Adds points to a user and returns their PunishedUser."""
+        punished = self.get(userid)
+        if punished is None:
+            punished = PunishedUser(userid, points, now)
+        else:
+            punished.points = punished.score(now) + points
+            punished.lastPunished = now
+        self.save(punished)
+        return punished
+
+    def save(self, punished):
+        self.backend.put('punished', punished.name, punished.toRecord(),
+                         expires = toMillis(punished.expires()) / 1000)
 
 # Importat variables
-spamTracker = {}
+spamTracker = FloodTracker()
+# Flooding is only ever about one room, and a room is only moderated by the
+# process in it, so spamTracker stays in the process. Offenders and raids are
+# spread over rooms, so those go through the state backend, see useStateBackend
+stateBackend = MemoryBackend()
+punishedUsers = PunishedUsers(stateBackend)
+messageSketch = WindowedSketch(stateBackend, 'raids')
 infractionScore = {
     'groupchat': 0,
     'caps': 1,
@@ -48,10 +170,10 @@ infractionScore = {
     'badlink': 2,
     'harmful': 3,
     'flooding': 3,
+    'raiding': 3,
     'banword': 3,
     'roomban': 10
 }
-punishedUsers = {}
 actionReplies = {
     'groupchat': "Don't link groupchats in here please.",
     'caps': 'Would you mind not using caps so much, please.',
@@ -59,16 +181,27 @@ actionReplies = {
     'badlink': 'The link has nothing to do with NU.',
     'harmful': "Don't use spoiler: with all caps like that.",
     'flooding': "Don't spam, please :c",
+    'raiding': "Don't paste the same message over and over, please.",
     'banword': "You can't say that in here, so please don't.",
     'roomban': "You are banned from this room."
 }
-banned = {}
-with open('plugins/bans.yaml', 'a+') as yf:
-        yf.seek(0, 0)
-        bans = yaml.load(yf)
-        if not bans:
-            bans = {'user':[],'phrase':[]}
-        banned = bans
+# Bans are kept as sets in memory and as lists in plugins/bans.yaml
+def loadBans(data):
+    bans = {'user': {}, 'phrase': {}}
+    for t in bans:
+        for room, things in ((data or {}).get(t) or {}).items():
+            bans[t][room] = set(things)
+    return bans
+def applyBan(bans, change):
+    kind, t, room, ban = change
+    if kind == 'add':
+        bans[t].setdefault(room, set()).add(ban)
+    elif kind == 'remove':
+        bans[t].get(room, set()).discard(ban)
+def dumpBans(bans):
+    return {t: {room: sorted(things) for room, things in bans[t].items()} for t in bans}
+banJournal = Journal('plugins/bans.yaml', loadBans, applyBan, dumpBans)
+banned = banJournal.state
 
 # Constants
 def MIN_CAPS_LENGTH(): return 12
@@ -76,34 +209,115 @@ def CAPS_PROPORTION(): return 0.9
 def MESSAGES_FOR_SPAM(): return 5
 def MIN_MESSAGE_TIME(): return timedelta(milliseconds = 300) * MESSAGES_FOR_SPAM()
 def SPAM_INTERVAL(): return timedelta(seconds = 6)
+def MAX_TRACKED_USERS(): return 2000
+def INFRACTION_HALF_LIFE(): return timedelta(hours = 12)
+def MIN_INFRACTION_SCORE(): return 0.5
+def RECENT_PUNISHMENT(): return timedelta(seconds = 3)
+def RAID_MESSAGES(): return 5
+def RAID_INTERVAL(): return timedelta(seconds = 30)
+def MIN_RAID_LENGTH(): return 16
+def RAID_SLICES(): return 6
+
+# Constants and regexes can be swapped out to try other settings, such as when
+# replaying logs through plugins/modreplay.py. The stretching ones are kept in
+# plugins/stretching.py, which rooms use as well
+tunables = {name: (module, value) for module in (sys.modules[__name__], stretching)
+            for name, value in vars(module).items()
+            if name.isupper() and (callable(value) or name.endswith('_REGEX'))}
+def configure(settings):
+    """Resets every constant and regex, then overrides the ones in settings.
+
+    Args:
+        settings: map, maps constant names to their new value. Durations are
+                  given in seconds and regexes as strings.
+    Raises:
+        KeyError: one of the names isn't a constant in this file.
+    """
+    for name, (module, value) in tunables.items():
+        setattr(module, name, value)
+    for name, value in settings.items():
+        module, default = tunables[name]
+        if name.endswith('_REGEX'):
+            value = re.compile(value, flags = default.flags & re.I)
+        elif isinstance(default(), timedelta):
+            value = (lambda seconds: lambda: timedelta(seconds = seconds))(value)
+        else:
+            value = (lambda value: lambda: value)(value)
+        setattr(module, name, value)
+
+def resetState():
+    """Forgets every tracked message, punishment and rule statistic.
+
+    This clears the state backend too, even when it's shared with other bots.
+    """
+    spamTracker.clear()
+    stateBackend.clear()
+    rules.resetStats()
+
+def useStateBackend(backend):
+    """Keeps offenders and raid counts in backend from now on.
+
+    Args:
+        backend: StateBackend object, such as a SQLiteBackend shared with
+                 other bot processes.
+    """
+    global stateBackend
+    stateBackend.close()
+    stateBackend = backend
+    punishedUsers.backend = backend
+    messageSketch.backend = backend
 
 def addBan(t, room, ban):
-    if room not in banned[t]:
-        banned[t][room] = []
     if t == 'user':
         ban = re.sub(r'[^a-zA-z0-9]', '', ban).lower()
-        if ban in banned['user'][room]:
+        if ban in banned['user'].get(room, ()):
             return 'User already banned in this room'
-    elif t == 'phrase' and ban in banned['phrase'][room]:
+    elif t == 'phrase' and ban in banned['phrase'].get(room, ()):
             return 'Phrase already banned'
-    banned[t][room].append(ban)
-    with open('plugins/bans.yaml', 'w') as yf:
-        yaml.dump(banned, yf)
+    banJournal.record('add', t, room, ban)
 
 def removeBan(t, room, ban):
-    ban = re.sub(r'[^a-zA-z0-9]', '', ban).lower()
-    if t == 'user' and ban not in banned['user'][room]:
+    if t == 'user':
+        ban = re.sub(r'[^a-zA-z0-9]', '', ban).lower()
+    if t == 'user' and ban not in banned['user'].get(room, ()):
             return 'User not banned'
-    elif t == 'phrase' and ban not in banned['phrase'][room]:
+    elif t == 'phrase' and ban not in banned['phrase'].get(room, ()):
             return 'Phrase not banned'
-    banned[t][room].remove(ban)
-    with open('plugins/bans.yaml', 'w') as yf:
-        yaml.dump(banned, yf)
+    banJournal.record('remove', t, room, ban)
 
 def shouldBan(bot, user, room):
     return room.moderate and isBanned(user.id, room.title) and bot.canBan(room)
 def isBanned(user, room):
-    return user in banned['user'][room]
+    return user in banned['user'].get(room, ())
+
+class Features:
+    """What the moderation rules look at in a message, worked out only once.
+
+    Attributes:
+        text: string, the message as it was sent.
+        lower: string, the message in lower case.
+        length: int, number of characters that aren't spaces.
+        caps: int, number of upper case letters.
+    Anything more expensive is worked out the first time a rule asks for it.
+    """
+    def __init__(self, msg):
+        self.text = msg
+        self.lower = msg.lower()
+        self.length, self.caps = capsCounts(msg)
+        self.memo = {}
+
+    def stripped(self, names):
+        """Returns the length and caps count of the text without any names."""
+        if names not in self.memo:
+            text = names.strip(self.text)
+            self.memo[names] = (self.length, self.caps) if text == self.text else capsCounts(text)
+        return self.memo[names]
+
+    def links(self):
+        """Returns every link in the message."""
+        if 'links' not in self.memo:
+            self.memo['links'] = getLinks(self.text)
+        return self.memo['links']
 
 class PunishedUser:
     def __init__(self, name, score, now):
@@ -112,57 +326,148 @@ class PunishedUser:
         self.lastPunished = now
         self.lastAction = ''
 
+    @classmethod
+    def fromRecord(cls, name, record):
+        punished = cls(name, record['points'], datetime.utcfromtimestamp(record['lastPunished']))
+        punished.lastAction = record['lastAction']
+        return punished
+
+    def toRecord(self):
+        return {'points': self.points, 'lastPunished': toMillis(self.lastPunished) / 1000,
+                'lastAction': self.lastAction}
+
+    def score(self, now):
+        """Returns the points left after halving every INFRACTION_HALF_LIFE."""
+        halfLives = max(now - self.lastPunished, timedelta(0)) / INFRACTION_HALF_LIFE()
+        return self.points * 0.5 ** halfLives
+
+    def expires(self):
+        """Returns when the points will have decayed below MIN_INFRACTION_SCORE,
+        but never before the punishment stops being recent."""
+        recent = self.lastPunished + RECENT_PUNISHMENT()
+        if self.points <= MIN_INFRACTION_SCORE():
+            return recent
+        return max(recent, self.lastPunished + INFRACTION_HALF_LIFE() *
+                   math.log2(self.points / MIN_INFRACTION_SCORE()))
+
+def urlWindow(text, hint, pos):
+    # Only characters in URL_LEAD_REGEX can come before the first hint of a
+    # link, so a match using this hint starts after pos in the run of those
+    # right in front of it
+    lead = URL_LEAD_REGEX.match(text[hint - 1:pos - 1 if pos else None:-1] if hint > pos else '')
+    return hint - lead.end()
+
+def findUrls(text):
+    # Same matches as URL_REGEX.finditer. Every link it finds contains one of
+    # the URL_HINT_REGEX substrings, so the regex only has to search from the
+    # first hint on, and text without any is never searched at all. Taking
+    # the spaces out can make a '://' but never a '.', '@' or ':', so look
+    # for those before doing that.
+    # The hints only hold for the URL_REGEX in this file, so one set through
+    # configure is run the slow way
+    if URL_REGEX is not tunables['URL_REGEX'][1]:
+        yield from URL_REGEX.finditer(text.replace(' ',''))
+        return
+    if '.' not in text and '@' not in text and ':' not in text:
+        return
+    text = text.replace(' ','')
+    pos = 0
+    while True:
+        hint = URL_HINT_REGEX.search(text, pos)
+        if not hint:
+            return
+        match = URL_REGEX.search(text, urlWindow(text, hint.start(), pos))
+        if not match:
+            return
+        yield match
+        pos = match.end()
+
 def getUrl(text):
-    match = re.search(URL_REGEX, text.replace(' ',''))
-    if match:
+    for match in findUrls(text):
         return match.group(0)
-    else:
-        return False
+    return False
+
+def getUrls(text):
+    return [match.group(0) for match in findUrls(text)]
+
+def getLinks(text):
+    # Links are found with the spaces taken out so that 'site . com' is still
+    # caught, but that also glues the word in front onto the host, like
+    # 'checksmogon.com' for 'check smogon.com'. The links that are there as
+    # written are used instead, and only what is left between them is taken
+    # with the spaces out
+    links, starts = [], None
+    for match in findUrls(text):
+        if starts is None:
+            starts = [i for i, char in enumerate(text) if char != ' ']
+        start, end = starts[match.start()], starts[match.end() - 1] + 1
+        for written in URL_REGEX.finditer(text, start, end):
+            links.extend(getUrls(text[start:written.start()]))
+            links.append(written.group(0))
+            start = written.end()
+        links.extend(getUrls(text[start:end]))
+    return links
 
 def containUrl(msg):
     if getUrl(msg):
         return True
     return False
 
-def badLink(link):
-    if any(u in link for u in urlShorteners):
-        if not link.startswith('http://'): link = 'http://' + link
-        resp = urlopen(link)
-        if 200 <= resp.getcode() > 400:
-            link = resp.url()
-        else:
+def getHost(link):
+    # urlsplit only finds the host after a '//', and links in chat rarely
+    # come with a scheme
+    if '://' not in link: link = '//' + link
+    try:
+        return (urlsplit(link).hostname or '').rstrip('.')
+    except ValueError:
+        return ''
+
+def isWhitelisted(host, room = None):
+    if whitelistedDomains.matches(host):
+        return True
+    return room is not None and room.linkwhitelist.matches(host)
+
+def badLink(link, room = None, onResolved = None):
+    host = getHost(link)
+    if shortenerDomains.matches(host):
+        resolved, target = linkResolver.lookup(link)
+        if not resolved:
+            # Following the redirect can take a while, so let it pass for now
+            # and report it through onResolved once we know where it leads
+            if onResolved:
+                linkResolver.resolve(link, lambda target: target and
+                                     badLink(target, room) and onResolved())
             return False
-    if not any(u in link for u in whitelistedUrls):
-        if not link.startswith('http://'): link = 'http://' + link
-        if 'youtube.com' in link:
+        if not target:
+            return False
+        host = getHost(target)
+    if not isWhitelisted(host, room):
+        if host == 'youtube.com' or host.endswith('.youtube.com'):
             # check youtube links better than the others because videos might still
             # be inappropriate, even if YouTube isn't
             pass
         return True
     return False
 def recentlyPunished(user, now):
-    if user.id not in punishedUsers:
+    punished = punishedUsers.get(user.id)
+    if punished is None:
         return False
-    timeDiff = now - punishedUsers[user.id].lastPunished
-    return timeDiff < timedelta(seconds = 3)
+    timeDiff = now - punished.lastPunished
+    return timeDiff < RECENT_PUNISHMENT()
 def isBanword(msg, room):
-    for ban in banned['phrase'][room]:
+    # Bans are added and removed on the receive thread while this runs on
+    # the moderation worker, so go over a copy
+    for ban in tuple(banned['phrase'].get(room, ())):
         if ban.lower() in msg:
             return True
     return False
+def toMillis(time):
+    return (time - datetime(1970, 1, 1)) // timedelta(milliseconds = 1)
 def isSpam(msg, user, room, now):
-    if room not in spamTracker:
-        spamTracker[room] = {}
-    if user.id not in spamTracker[room]:
-        spamTracker[room][user.id] = deque('', 50)
-        # The first time this user have talked, so there's no way it's spam now
+    oldest = spamTracker.add(room, user.id, toMillis(now))
+    if oldest is None:
         return False
-    spamTracker[room][user.id].append(now)
-    times = spamTracker[room][user.id]
-    timesLen = len(times)
-    if timesLen < MESSAGES_FOR_SPAM():
-         return False
-    timeDiff = now - times[timesLen - MESSAGES_FOR_SPAM()]
+    timeDiff = timedelta(milliseconds = toMillis(now) - oldest)
     if (
       timeDiff < SPAM_INTERVAL() and
       timeDiff > MIN_MESSAGE_TIME()
@@ -172,50 +477,54 @@ def isSpam(msg, user, room, now):
     # 2: At least 300ms between every message
         return True
     return False
-def isStretching(msg, users):
-    for user in users:
-        # If a username trigger the stretching, remove the username from the message
-        # to stop malicious usernames
-        if re.search(STRETCH_REGEX, user):
-            msg = msg.replace(user, '')
-        if re.search(STRETCH_REGEX, users[user].name):
-            msg = msg.replace(users[user].name, '')
-
-    if re.search(STRETCH_REGEX, msg):
-        return True
-    return False
-def isCaps(msg, users):
-    # To make sure no username triggers this, replace them with empty strings before
-    # doing the actual check
-    for user in users:
-        msg = msg.replace(users[user].name, '')
-    capsCount = len(re.findall(r'[A-Z]', re.sub(r'[^A-Za-z]', '', msg)))
-    return capsCount and len(re.sub(r' ','',msg)) > MIN_CAPS_LENGTH() and capsCount >= int(len(re.sub(r' ','',msg)) * CAPS_PROPORTION())
+def fingerprint(msg):
+    # Ignoring case, spacing and punctuation catches the usual small edits
+    # made to get past filters
+    text = re.sub(PUNCTUATION_REGEX, '', msg.lower())
+    if len(text) < MIN_RAID_LENGTH():
+        return None
+    return int.from_bytes(hashlib.sha1(text.encode()).digest()[:8], 'little')
+def isRaid(msg, now):
+    # The same message showing up too often across all rooms, whether from one
+    # user or many, is most likely a raid
+    key = fingerprint(msg)
+    if key is None:
+        return False
+    return messageSketch.add(key, toMillis(now) / 1000, RAID_INTERVAL().total_seconds(),
+                             RAID_SLICES()) > RAID_MESSAGES()
+def isStretching(msg, names):
+    # Usernames that trigger the stretching themselves are collected in names
+    # when the user joins, so remove them to stop malicious usernames
+    return triggersStretching(names.strip(msg))
+def capsCounts(msg):
+    return len(msg) - msg.count(' '), len(re.findall(CAPS_REGEX, msg))
+def tooManyCaps(length, capsCount):
+    return capsCount and length > MIN_CAPS_LENGTH() and capsCount >= int(length * CAPS_PROPORTION())
+def isCaps(msg, names):
+    # To make sure no username triggers this, remove them before doing the
+    # actual check
+    return tooManyCaps(*capsCounts(names.strip(msg)))
 def isGroupMention(msg):
     if re.search(GROUP_REGEX, msg):
         return True
     return False
 
-def probablyHarmful(msg, userlist):
+def probablyHarmful(msg, names):
     # Arguably using `spoiler:` and all caps is never something that will occur
     # so rather than letting the other monitors take it, deal with it here.
     # Just make sure the message is long enough to not be a mistake.
     if 'spoiler:' in msg:
         hidden = msg[msg.index('spoiler:') + len('spoiler:'):]
-        return isCaps(hidden, userlist) and len(hidden) > 20
+        return isCaps(hidden, names) and len(hidden) > 20
     return False
 
 def getAction(bot, room, user, wrong, unixTime):
     # This assumes unixTime is a valid unix timestamp
     now = datetime.utcfromtimestamp(int(unixTime))
 
-    if user.id not in punishedUsers:
-        punishedUsers[user.id] = PunishedUser(user.id, infractionScore[wrong], now)
-    else:
-        punishedUsers[user.id].points += infractionScore[wrong]
-        punishedUsers[user.id].lastPunished = now
-
-    score =  punishedUsers[user.id].points
+    # The score has decayed since the last punishment, see PunishedUser
+    punished = punishedUsers.punish(user.id, infractionScore[wrong], now)
+    score = punished.points
     action = ''
     # Under 3 points are low and warning is enough
     if score < 3:
@@ -234,46 +543,53 @@ def getAction(bot, room, user, wrong, unixTime):
     # If the current rank doesn't support roomban, keep muting them
     if action == 'roomban' and not bot.canBan(room):
         action = 'hourmute'
-    punishedUsers[user.id].lastAction = action
+    punished.lastAction = action
+    punishedUsers.save(punished)
     return action, actionReplies[wrong]
 
-nextReset = datetime.now().date() + timedelta(days = 2)
-def shouldAct(msg, user, room, unixTime):
-    global nextReset
+# The rules every message is checked against. The cost is only used to order
+# them, so cheap rules get a chance to hit before the expensive ones run.
+# Gated rules are skipped for users that were just punished, and only the
+# directly harmful rules are on unless a room picks its own with ~modrule.
+def checkBanned(features, user, room, now, onLater):
+    return isBanned(user.id, room.title)
+def checkSpam(features, user, room, now, onLater):
+    return isSpam(features.text, user, room.title, now)
+def checkRaid(features, user, room, now, onLater):
+    return isRaid(features.lower, now)
+def checkBanword(features, user, room, now, onLater):
+    return isBanword(features.lower, room.title)
+def checkHarmful(features, user, room, now, onLater):
+    return probablyHarmful(features.text, room.names)
+def checkGroupMention(features, user, room, now, onLater):
+    return 'groupchat' in features.lower and isGroupMention(features.text)
+def checkCaps(features, user, room, now, onLater):
+    return tooManyCaps(*features.stripped(room.names))
+def checkStretching(features, user, room, now, onLater):
+    return isStretching(features.text, room.stretchingNames)
+def checkLinks(features, user, room, now, onLater):
+    later = (lambda: onLater('badlink')) if onLater else None
+    return any(badLink(link, room, later) for link in features.links())
 
+rules = RuleEngine([
+    Rule('roomban', checkBanned, 1),
+    Rule('flooding', checkSpam, 2),
+    Rule('banword', checkBanword, 3),
+    Rule('raiding', checkRaid, 4),
+    Rule('harmful', checkHarmful, 5, gated = True),
+    Rule('groupchat', checkGroupMention, 6, gated = True, default = False),
+    Rule('caps', checkCaps, 7, gated = True, default = False),
+    Rule('stretching', checkStretching, 9, gated = True, default = False),
+    Rule('badlink', checkLinks, 11, gated = True, default = False)
+], recentlyPunished)
+
+def shouldAct(msg, user, room, unixTime, onLater = None, features = None):
+    # onLater(wrong) is called for checks that can't be decided right away,
+    # such as shortened links that still have to be followed
     now = datetime.utcfromtimestamp(int(unixTime))
-    # Clear the punishment scores every two days
-    if now.date() == nextReset:
-        punishedUsers.clear()
-        nextReset = now.date() + timedelta(days = 2)
-
-    if isBanned(user, room.title):
-        return 'roomban'
-    if isSpam(msg, user, room.title, now):
-        return 'flooding'
-    if isBanword(msg.lower(), room.title):
-        return 'banword'
-    if recentlyPunished(user, now):
-        return False
-    if probablyHarmful(msg, room.users):
-        return 'harmful'
-# Disabled any moderating that isn't directly harmful to the rooms.
-# If moderating for stretching or caps is desired, uncomment the relevant
-# section of code. The recently punished test can stay to avoid forgetting
-# when re-enabling a function again.
-
-#    if isStretching(msg, room.users):
-#        return 'stretching'
-#    if isCaps(msg, room.users):
-#        return 'caps'
-
-#    if isGroupMention(msg):
-#        return 'groupchat'
-#    if containUrl(msg.lower()):
-#        url = moderation.getUrl(message[4])
-#        if badLink(url):
-#            return 'badlink'
-    return False
+    # Forget users whose points have decayed away and old raid counts
+    stateBackend.expire(toMillis(now) / 1000)
+    return rules.evaluate(features or Features(msg), user, room, now, onLater)
 
 
 # Commands
@@ -305,3 +621,34 @@ def unbanthing(bot, cmd, room, msg, user):
     if not error:
         return 'Removed {thing} from the banlist for room {room}'.format(thing = msg, room = room.title), True
     return error, True
+
+def modrule(bot, cmd, room, msg, user):
+    if room.title == 'pm': return "You can't use this command in a pm.", False
+    if not user.hasRank('#'): return 'You do not have permission to set this. (Requires #)', False
+    things = bot.removeSpaces(msg).lower().split(',')
+    if not len(things) == 2 or things[0] not in rules.rules or things[1] not in ['on', 'off']:
+        return 'Command is ~modrule [rule],on/off. Rules are: {rules}'.format(rules = ', '.join(rules.rules)), False
+    enabled = set(rules.enabled(room))
+    if things[1] == 'on':
+        enabled.add(things[0])
+    else:
+        enabled.discard(things[0])
+    room.rules = enabled
+    bot.saveDetails()
+    return 'Moderating for {rule} is now {state} in this room'.format(rule = things[0], state = things[1]), True
+
+def modstats(bot, cmd, room, msg, user):
+    if not user.hasRank('%'): return 'You do not have permission to see this. (Requires %)', False
+    enabled = rules.enabled(room) if room.title != 'pm' else rules.defaults()
+    lines = []
+    for rule in rules:
+        lines.append('{name} ({state}): {hits} hits in {calls} checks, {avg:.1f}us per check'.format(
+                     name = rule.name, state = 'on' if rule.name in enabled else 'off',
+                     hits = rule.hits, calls = rule.calls, avg = rule.averageTime() * 1e6))
+    lines.append('Tracking {users} users for flooding and {punished} with infraction points'.format(
+                 users = spamTracker.trackedUsers(), punished = len(punishedUsers)))
+    if getattr(bot, 'modqueue', None):
+        lines.append('{depth} messages queued, {avg:.1f}ms average and {most:.1f}ms longest wait for a decision'.format(
+                     depth = bot.modqueue.depth(), avg = bot.modqueue.averageLatency() * 1e3,
+                     most = bot.modqueue.maxLatency * 1e3))
+    return '\n'.join(lines), False
@@ -0,0 +1,115 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 QuiteQuiet
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Deciding on moderation used to happen while handling a chat message, so any
+# slow rule held up every message after it. The receive thread now only queues
+# the message, and a worker thread runs the rules and takes the actions.
+
+from collections import OrderedDict
+import queue
+from threading import Thread
+import time
+
+from plugins import moderation
+
+
+class ModerationQueue:
+    """Runs moderation for queued chat messages on a worker thread.
+
+    The rules run on the worker, while bans are still changed by commands on
+    the receive thread, so the rules only read those. Whatever has queued up
+    while it was busy is handled as one batch, and a user that broke rules
+    several times in a batch gets a single action for the worst of them. A
+    message that fails to be moderated is skipped without the rest of its
+    batch.
+
+    Attributes:
+        act: function taking (room, user, wrong, unixTime) that punishes the
+             user, see PSBot.punish.
+        decisions: int, messages moderated so far.
+        totalLatency: float, seconds between queueing and deciding, summed
+                      over every message.
+        maxLatency: float, the longest any message waited for a decision.
+    """
+    def __init__(self, act):
+        self.act = act
+        self.queue = queue.Queue()
+        self.decisions = 0
+        self.totalLatency = 0.0
+        self.maxLatency = 0.0
+        self.thread = Thread(target = self.work, name = 'moderation',
+                             daemon = True)
+        self.thread.start()
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def averageLatency(self):
+        return self.totalLatency / self.decisions if self.decisions else 0.0
+
+    def put(self, msg, user, room, unixTime):
+        """Queues a chat message to be moderated."""
+        self.queue.put((time.perf_counter(), None, msg, user, room, unixTime,
+                        moderation.Features(msg)))
+
+    def putDecided(self, wrong, user, room, unixTime):
+        """Queues a violation that was found outside of the worker."""
+        self.queue.put((time.perf_counter(), wrong, None, user, room, unixTime,
+                        None))
+
+    def work(self):
+        while True:
+            batch = [self.queue.get()]
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            self.handle(batch)
+
+    def handle(self, batch):
+        worst = OrderedDict()
+        for queued, wrong, msg, user, room, unixTime, features in batch:
+            if wrong is None:
+                onLater = (lambda user, room, unixTime: lambda wrong:
+                           self.putDecided(wrong, user, room, unixTime))(user, room, unixTime)
+                try:
+                    wrong = moderation.shouldAct(msg, user, room, unixTime,
+                                                 onLater, features)
+                except Exception as e:
+                    print('Moderation failed:', e)
+                    wrong = False
+                latency = time.perf_counter() - queued
+                self.decisions += 1
+                self.totalLatency += latency
+                self.maxLatency = max(self.maxLatency, latency)
+            if not wrong:
+                continue
+            key = (room.title, user.id)
+            if (key not in worst or moderation.infractionScore[wrong] >
+                    moderation.infractionScore[worst[key][0]]):
+                worst[key] = (wrong, user, room, unixTime)
+        for wrong, user, room, unixTime in worst.values():
+            try:
+                self.act(room, user, wrong, unixTime)
+            except Exception as e:
+                print('Moderation failed:', e)
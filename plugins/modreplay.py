@@ -0,0 +1,248 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 QuiteQuiet
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Replays chat logs through the moderation rules without acting on anything,
+# to see what other thresholds would do before trying them in a live room.
+#
+# Usage (from the folder app.py is in):
+#   python3 -m plugins.modreplay [-c config.yaml [-c other.yaml]] [-j jobs] logs...
+#
+# Logs can be in the format the server sends to the bot
+# ("|c:|1467521329|+user|message") or the one in the server's chatlogs
+# ("12:34:56 |c|+user|message"), where the date is taken from a YYYY-MM-DD in
+# the file name. Joins, leaves and renames are followed so usernames are
+# handled like in a live room.
+#
+# A config is a yaml map of constants or regexes in moderation.py to override,
+# for example {CAPS_PROPORTION: 0.8, SPAM_INTERVAL: 4}, and can also set
+# 'rules' to the list of rules to run. Every rule runs by default. With two
+# configs, the messages they judge differently are reported as well.
+
+import argparse
+import calendar
+from collections import Counter
+from multiprocessing import Pool
+import os
+import re
+import time
+
+import yaml
+
+from plugins import moderation
+from room import Room
+from user import toId
+from user import users
+
+DATE_REGEX = re.compile(r'(\d{4})-(\d{2})-(\d{2})')
+# Only this many differing messages are kept per file to show as examples
+DIFF_EXAMPLES = 10
+
+
+class ShadowBot:
+    """Stands in for PSBot when deciding on actions, without sending any."""
+    def canBan(self, room):
+        return True
+
+
+class Replay:
+    """Result of replaying logs with one config.
+
+    Attributes:
+        messages: int, chat messages moderated.
+        seconds: float, time spent moderating them.
+        hits: Counter, maps rules to how often they hit.
+        actions: Counter, maps actions getAction took to how often.
+    """
+    def __init__(self):
+        self.messages = 0
+        self.seconds = 0.0
+        self.hits = Counter()
+        self.actions = Counter()
+
+    def merge(self, other):
+        self.messages += other.messages
+        self.seconds += other.seconds
+        self.hits.update(other.hits)
+        self.actions.update(other.actions)
+
+
+def readLog(path):
+    """Yields (unixTime, kind, parts) for every line in a log."""
+    day = DATE_REGEX.search(os.path.basename(path))
+    dayStart = calendar.timegm((int(day.group(1)), int(day.group(2)),
+                                int(day.group(3)), 0, 0, 0)) if day else 0
+    lastTime = dayStart
+    with open(path, 'r', encoding = 'utf-8', errors = 'replace') as log:
+        for line in log:
+            line = line.rstrip('\n')
+            if line[:1].isdigit() and ' |' in line:
+                clock, line = line.split(' ', 1)
+                h, m, s = (clock.split(':') + ['0', '0'])[:3]
+                try:
+                    lastTime = dayStart + int(h) * 3600 + int(m) * 60 + int(s)
+                except ValueError:
+                    continue
+            parts = line.split('|')
+            if len(parts) < 3:
+                continue
+            kind = parts[1].lower()
+            if kind == 'c:':
+                if len(parts) < 5:
+                    continue
+                lastTime = int(parts[2]) if parts[2].isdigit() else lastTime
+                yield lastTime, 'c', [parts[3], '|'.join(parts[4:])]
+            elif kind == 'c':
+                if len(parts) < 4:
+                    continue
+                yield lastTime, 'c', [parts[2], '|'.join(parts[3:])]
+            else:
+                yield lastTime, kind, parts[2:]
+
+
+def replayFile(path, settings):
+    """Replays one log with a config.
+
+    Returns:
+        A pair of a Replay and a list with the violation found in every chat
+        message, or None for messages that broke no rule.
+    """
+    moderation.configure({k: v for k, v in settings.items() if k != 'rules'})
+    moderation.resetState()
+    room = Room(os.path.splitext(os.path.basename(path))[0])
+    room.rules = set(settings.get('rules', moderation.rules.rules))
+    bot = ShadowBot()
+    result = Replay()
+    verdicts = []
+    for unixTime, kind, parts in readLog(path):
+        if kind in ('j', 'join') and parts[0]:
+            room.addUser(users.member(parts[0][1:], parts[0][0]))
+        elif kind in ('l', 'leave') and parts[0]:
+            room.removeUser(toId(parts[0][1:]))
+        elif kind == 'n' and len(parts) > 1 and parts[0]:
+            room.renamedUser(toId(parts[1]), users.member(parts[0][1:], parts[0][0]))
+        elif kind == 'users':
+            room.addUsers(users.members([name for name in parts[0].split(',')[1:] if name]))
+        elif kind == 'c' and parts[0]:
+            user = room.getUser(toId(parts[0][1:]))
+            if not user:
+                user = users.member(parts[0][1:], parts[0][0])
+                room.addUser(user)
+            start = time.perf_counter()
+            wrong = moderation.shouldAct(parts[1], user, room, unixTime)
+            if wrong:
+                action, reason = moderation.getAction(bot, room, user, wrong,
+                                                      unixTime)
+                result.hits[wrong] += 1
+                result.actions[action] += 1
+            result.seconds += time.perf_counter() - start
+            result.messages += 1
+            verdicts.append(wrong or None)
+    room.clearUsers()
+    return result, verdicts
+
+
+def replayWork(job):
+    """Replays a log with every config and compares the verdicts."""
+    path, configs = job
+    results, allVerdicts = [], []
+    for settings in configs:
+        result, verdicts = replayFile(path, settings)
+        results.append(result)
+        allVerdicts.append(verdicts)
+    changes, examples = Counter(), {}
+    if len(configs) == 2:
+        for i, (a, b) in enumerate(zip(*allVerdicts)):
+            if a != b:
+                changes[(a, b)] += 1
+                if len(examples) < DIFF_EXAMPLES:
+                    examples[i] = (a, b)
+    # Read the log again for the text of the examples rather than keeping
+    # every message around while replaying
+    found = []
+    if examples:
+        messages = (parts for _, kind, parts in readLog(path) if kind == 'c' and parts[0])
+        for i, parts in enumerate(messages):
+            if i in examples:
+                found.append((parts[0], parts[1]) + examples[i])
+    return results, changes, found
+
+
+def report(name, result):
+    print('== {name}'.format(name = name))
+    rate = result.messages / result.seconds if result.seconds else 0
+    print('{n} messages, {rate:.0f} messages/s through the rules'.format(
+          n = result.messages, rate = rate))
+    for rule, hits in result.hits.most_common():
+        print('  {rule}: {hits} hits'.format(rule = rule, hits = hits))
+    for action, count in result.actions.most_common():
+        print('  would {action}: {count}'.format(action = action, count = count))
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Replay chat logs through '
+                                     'the moderation rules in shadow mode.')
+    parser.add_argument('logs', nargs = '+', help = 'log files to replay')
+    parser.add_argument('-c', '--config', action = 'append', default = [],
+                        help = 'yaml file with settings to use, at most twice')
+    parser.add_argument('-j', '--jobs', type = int, default = os.cpu_count(),
+                        help = 'number of processes replaying logs')
+    args = parser.parse_args()
+    if len(args.config) > 2:
+        parser.error('at most two configs can be compared')
+    configs = []
+    for path in args.config:
+        with open(path, 'r') as yf:
+            configs.append(yaml.safe_load(yf) or {})
+    names = args.config or ['defaults']
+    if not configs:
+        configs = [{}]
+
+    start = time.perf_counter()
+    totals = [Replay() for _ in configs]
+    changes, examples = Counter(), []
+    with Pool(args.jobs) as pool:
+        jobs = [(path, configs) for path in args.logs]
+        for done, (results, fileChanges, fileExamples) in enumerate(
+                pool.imap_unordered(replayWork, jobs), 1):
+            for total, result in zip(totals, results):
+                total.merge(result)
+            changes.update(fileChanges)
+            examples.extend(fileExamples)
+            print('{done}/{total} logs, {n} messages'.format(
+                  done = done, total = len(jobs), n = totals[0].messages), end = '\r')
+    wall = time.perf_counter() - start
+    print()
+    print('Replayed {n} logs in {wall:.1f}s, {rate:.0f} messages/s overall'.format(
+          n = len(args.logs), wall = wall,
+          rate = sum(total.messages for total in totals) / wall))
+    for name, total in zip(names, totals):
+        report(name, total)
+    if len(configs) == 2:
+        print('== {n} messages judged differently'.format(n = sum(changes.values())))
+        for (a, b), count in changes.most_common():
+            print('  {a} -> {b}: {count}'.format(a = a, b = b, count = count))
+        for user, text, a, b in examples[:DIFF_EXAMPLES]:
+            print('  {a} -> {b}: {user}: {text}'.format(a = a, b = b, user = user, text = text))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 QuiteQuiet
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Names of the users in a room, taken out of messages before checking them
+# for caps or stretching so that nobody is punished for their own name.
+
+from collections import Counter
+
+
+class NameMatcher:
+    """Removes every occurrence of a set of names from a text in one pass.
+
+    The names are counted in a dict, and the lengths they come in are kept by
+    their first character. At every position of a message only the lengths
+    of the names starting with that character are tried, longest first, so
+    a message is scanned once no matter how many users are in the room, and
+    next to the names themselves only a few small maps are kept.
+    """
+    def __init__(self):
+        self.names = Counter()
+        # First character -> how many different names of each length start
+        # with it, and those lengths from the longest down
+        self.lengths = {}
+        self.longestFirst = {}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, name):
+        if not name: return
+        self.names[name] += 1
+        self.size += 1
+        if self.names[name] > 1: return
+        lengths = self.lengths.setdefault(name[0], Counter())
+        lengths[len(name)] += 1
+        if lengths[len(name)] == 1:
+            self.longestFirst[name[0]] = sorted(lengths, reverse = True)
+
+    def remove(self, name):
+        if not self.names.get(name): return
+        self.names[name] -= 1
+        self.size -= 1
+        if self.names[name]: return
+        del self.names[name]
+        lengths = self.lengths[name[0]]
+        lengths[len(name)] -= 1
+        if lengths[len(name)]: return
+        del lengths[len(name)]
+        if lengths:
+            self.longestFirst[name[0]] = sorted(lengths, reverse = True)
+        else:
+            del self.lengths[name[0]], self.longestFirst[name[0]]
+
+    def strip(self, text):
+        if not self.size: return text
+        names, longestFirst = self.names, self.longestFirst
+        kept, start, i = [], 0, 0
+        length = len(text)
+        while i < length:
+            # Find the longest name starting at i
+            for size in longestFirst.get(text[i], ()):
+                if text[i:i + size] in names:
+                    kept.append(text[start:i])
+                    start = i = i + size
+                    break
+            else:
+                i += 1
+        kept.append(text[start:])
+        return ''.join(kept)
@@ -0,0 +1,113 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 QuiteQuiet
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Moderation is done by running a message through a list of rules. Each rule
+# keeps track of how often it hits and how long it takes, so rooms can see
+# what the expensive ones cost before turning them on.
+
+import time
+
+
+class Rule:
+    """A single check a chat message can fail.
+
+    Attributes:
+        name: string, the violation reported when the check hits.
+        check: function taking (features, user, room, now, onLater) that
+               returns True when the message breaks this rule.
+        cost: int, how expensive the check is compared to the others. Cheaper
+              rules are tried first.
+        gated: Bool, if the rule is skipped for users that were just punished.
+        default: Bool, if the rule is on in rooms that didn't pick their rules.
+        calls: int, times the check has run.
+        hits: int, times the check has hit.
+        time: float, seconds spent in the check in total.
+    """
+    def __init__(self, name, check, cost, gated = False, default = True):
+        self.name = name
+        self.check = check
+        self.cost = cost
+        self.gated = gated
+        self.default = default
+        self.calls = 0
+        self.hits = 0
+        self.time = 0.0
+
+    def averageTime(self):
+        return self.time / self.calls if self.calls else 0.0
+
+    def run(self, *args):
+        start = time.perf_counter()
+        hit = self.check(*args)
+        self.time += time.perf_counter() - start
+        self.calls += 1
+        if hit:
+            self.hits += 1
+        return hit
+
+
+class RuleEngine:
+    """Runs the rules enabled in a room and stops at the first one that hits.
+
+    Rules that aren't gated are tried first, in order of cost. Then gate is
+    asked if the gated rules should run at all, and if so they are tried in
+    order of cost as well.
+
+    Attributes:
+        rules: map, maps rule names to Rule objects.
+        gate: function taking (user, now) that returns True when the gated
+              rules should be skipped.
+    """
+    def __init__(self, rules, gate):
+        self.rules = {rule.name: rule for rule in rules}
+        self.order = sorted(rules, key = lambda rule: (rule.gated, rule.cost))
+        self.gate = gate
+
+    def __iter__(self):
+        return iter(self.order)
+
+    def defaults(self):
+        return {rule.name for rule in self.order if rule.default}
+
+    def enabled(self, room):
+        """Returns the names of the rules that are on in the room."""
+        return self.defaults() if room.rules is None else room.rules
+
+    def evaluate(self, features, user, room, now, onLater = None):
+        """Returns the name of the first rule that hits, or False."""
+        enabled = self.enabled(room)
+        gateChecked = False
+        for rule in self.order:
+            if rule.name not in enabled:
+                continue
+            if rule.gated and not gateChecked:
+                if self.gate(user, now):
+                    return False
+                gateChecked = True
+            if rule.run(features, user, room, now, onLater):
+                return rule.name
+        return False
+
+    def resetStats(self):
+        for rule in self.order:
+            rule.calls = rule.hits = 0
+            rule.time = 0.0
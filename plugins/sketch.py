@@ -0,0 +1,81 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 QuiteQuiet
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Counting every distinct message would take memory that grows with the
+# traffic, so messages are counted in a sketch of a fixed size instead.
+
+
+class WindowedSketch:
+    """Estimates how often keys were seen recently in a fixed number of counters.
+
+    The window is split into slices, and every slice has a count-min sketch
+    of its own: depth rows of width counters, where a key adds one to a
+    counter in every row. The estimate for a key is the smallest of its
+    counters summed over the slices still in the window. Keys sharing
+    counters can make it too high, but it is never too low.
+
+    The counters are kept in a StateBackend, so bot processes sharing one
+    share the sketch too. Each counter expires once its slice leaves the
+    window, so the backend never holds more than slices * depth * width of
+    them, however many different keys come by.
+
+    Attributes:
+        backend: StateBackend object holding the counters.
+        table: string, the backend table the counters go in.
+        width: int, counters per row.
+        depth: int, rows per slice.
+    """
+    # Multipliers for the row hashes, odd so every counter can be reached
+    SEEDS = (0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9,
+             0xD6E8FEB86659FD93, 0xFF51AFD7ED558CCD, 0xC4CEB9FE1A85EC53)
+
+    def __init__(self, backend, table, width = 1024, depth = 4):
+        self.backend = backend
+        self.table = table
+        self.width = width
+        self.depth = min(depth, len(self.SEEDS))
+
+    def cells(self, key):
+        return [row * self.width + ((key * seed) >> 40) % self.width
+                for row, seed in enumerate(self.SEEDS[:self.depth])]
+
+    def add(self, key, now, window, slices):
+        """Counts a key seen at the unix time now and returns its estimate.
+
+        Args:
+            key: int, a 64 bit hash of the thing seen.
+            now: float, unix time in seconds.
+            window: float, length of the window in seconds.
+            slices: int, how many parts the window is split into.
+        """
+        sliceLength = window / slices
+        current = int(now // sliceLength)
+        cells = self.cells(key)
+        totals = [self.backend.add(self.table, '{slice}/{cell}'.format(slice = current, cell = cell),
+                                   expires = (current + slices) * sliceLength)
+                  for cell in cells]
+        older = self.backend.counts(self.table, ['{slice}/{cell}'.format(slice = older, cell = cell)
+                                                 for older in range(current - slices + 1, current)
+                                                 for cell in cells])
+        for i, count in enumerate(older):
+            totals[i % len(cells)] += count
+        return min(totals)
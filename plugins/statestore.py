@@ -0,0 +1,302 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 QuiteQuiet
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Moderation state used to live in module-level dicts, so every bot process
+# only knew about the offenders it had seen itself. A StateBackend holds that
+# state instead, either in the process or in a SQLite file that several bot
+# processes on one machine share.
+
+import atexit
+import heapq
+import json
+import sqlite3
+from threading import Lock
+import time
+
+
+def openDatabase(path):
+    """Opens a SQLite database in WAL mode that any thread can use.
+
+    Callers still have to keep threads from using it at the same time.
+    """
+    db = sqlite3.connect(path, timeout = 10, isolation_level = None,
+                         check_same_thread = False)
+    db.execute('PRAGMA journal_mode = WAL')
+    db.execute('PRAGMA synchronous = NORMAL')
+    return db
+
+
+class StateBackend:
+    """Records and counters kept under a table name and a string key.
+
+    Records are json values that are written right away. Counters are meant
+    for things counted on every message: add() only has to touch memory, and
+    a backend shared between processes may write the counts back in batches,
+    so totals can lag behind what other processes counted for a short while.
+    Both can be given an expiry as a unix time, after which expire() drops
+    them.
+    """
+    def get(self, table, key, default = None):
+        """Returns the record stored under key, or default if there is none."""
+        raise NotImplementedError
+
+    def put(self, table, key, value, expires = None):
+        raise NotImplementedError
+
+    def delete(self, table, key):
+        raise NotImplementedError
+
+    def size(self, table):
+        """Returns how many records the table holds."""
+        raise NotImplementedError
+
+    def add(self, table, key, amount = 1, expires = None):
+        """Adds amount to a counter and returns its new total."""
+        raise NotImplementedError
+
+    def counts(self, table, keys):
+        """Returns the totals of the counters under keys, 0 for missing ones."""
+        raise NotImplementedError
+
+    def expire(self, now):
+        """Drops every record and counter that expired by the unix time now."""
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+
+class MemoryBackend(StateBackend):
+    """Keeps the state in this process only, which is all a single bot needs."""
+    def __init__(self):
+        # Both map table names to maps of keys to [value, expires]
+        self.records = {}
+        self.counters = {}
+        # (expires, kind, table, key), entries whose expiry has changed since
+        # are skipped when they come up
+        self.expiries = []
+
+    def schedule(self, kind, table, key, expires):
+        if expires is not None:
+            heapq.heappush(self.expiries, (expires, kind, table, key))
+
+    def get(self, table, key, default = None):
+        entry = self.records.get(table, {}).get(key)
+        return entry[0] if entry else default
+
+    def put(self, table, key, value, expires = None):
+        self.records.setdefault(table, {})[key] = [value, expires]
+        self.schedule('records', table, key, expires)
+
+    def delete(self, table, key):
+        self.records.get(table, {}).pop(key, None)
+
+    def size(self, table):
+        return len(self.records.get(table, ()))
+
+    def add(self, table, key, amount = 1, expires = None):
+        counters = self.counters.setdefault(table, {})
+        entry = counters.get(key)
+        if entry is None:
+            entry = counters[key] = [0, None]
+        entry[0] += amount
+        if expires is not None and (entry[1] is None or expires > entry[1]):
+            entry[1] = expires
+            self.schedule('counters', table, key, expires)
+        return entry[0]
+
+    def counts(self, table, keys):
+        counters = self.counters.get(table, {})
+        return [counters[key][0] if key in counters else 0 for key in keys]
+
+    def expire(self, now):
+        while self.expiries and self.expiries[0][0] <= now:
+            expires, kind, table, key = heapq.heappop(self.expiries)
+            entries = getattr(self, kind).get(table, {})
+            if key in entries and entries[key][1] == expires:
+                del entries[key]
+
+    def clear(self):
+        self.records.clear()
+        self.counters.clear()
+        del self.expiries[:]
+
+
+class SQLiteBackend(StateBackend):
+    """Keeps the state in a SQLite database that bot processes can share.
+
+    The database runs in WAL mode, so readers in one process don't block the
+    writer in another. Records are read and written straight from the
+    database. Counters never wait on it: increments are summed in memory and
+    written in one transaction once flushInterval seconds have passed, which
+    also reads back the totals of the counters used since the last flush.
+    Until then, totals are the last ones read plus what this process added
+    on top, so counts from other processes show up a flush late.
+
+    Attributes:
+        path: string, path of the database file.
+        flushInterval: float, seconds between writing counters back.
+        expireInterval: float, least seconds of message time between
+                        deleting expired rows.
+    """
+    def __init__(self, path, flushInterval = 1.0, expireInterval = 10.0):
+        self.path = path
+        self.flushInterval = flushInterval
+        self.expireInterval = expireInterval
+        # The moderation worker and commands on the receiving thread both
+        # use the connection
+        self.lock = Lock()
+        self.db = openDatabase(path)
+        for table in ('records', 'counters'):
+            self.db.execute('CREATE TABLE IF NOT EXISTS {table} (tbl TEXT, key TEXT, value, expires REAL, '
+                            'PRIMARY KEY (tbl, key))'.format(table = table))
+        # Counter totals as last read, what was added since the last flush,
+        # which counters were used since and when counters expire
+        self.known = {}
+        self.pending = {}
+        self.used = set()
+        self.expiries = {}
+        self.lastFlush = time.monotonic()
+        self.nextExpiry = None
+        atexit.register(self.close)
+
+    def get(self, table, key, default = None):
+        with self.lock:
+            row = self.db.execute('SELECT value FROM records WHERE tbl = ? AND key = ?', (table, key)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def put(self, table, key, value, expires = None):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?)',
+                            (table, key, json.dumps(value), expires))
+
+    def delete(self, table, key):
+        with self.lock:
+            self.db.execute('DELETE FROM records WHERE tbl = ? AND key = ?', (table, key))
+
+    def size(self, table):
+        with self.lock:
+            return self.db.execute('SELECT count(*) FROM records WHERE tbl = ?', (table,)).fetchone()[0]
+
+    def add(self, table, key, amount = 1, expires = None):
+        with self.lock:
+            entry = (table, key)
+            self.pending[entry] = self.pending.get(entry, 0) + amount
+            if expires is not None:
+                self.expiries[entry] = max(expires, self.expiries.get(entry, expires))
+            self.used.add(entry)
+            total = self.known.get(entry, 0) + self.pending[entry]
+            self.maybeWrite()
+            return total
+
+    def counts(self, table, keys):
+        with self.lock:
+            entries = [(table, key) for key in keys]
+            self.used.update(entries)
+            totals = [self.known.get(entry, 0) + self.pending.get(entry, 0) for entry in entries]
+            self.maybeWrite()
+            return totals
+
+    def maybeWrite(self):
+        if time.monotonic() - self.lastFlush >= self.flushInterval:
+            self.write()
+
+    def write(self):
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            for (table, key), amount in self.pending.items():
+                expires = self.expiries.get((table, key))
+                self.db.execute('INSERT OR IGNORE INTO counters VALUES (?, ?, 0, ?)', (table, key, expires))
+                if expires is None:
+                    self.db.execute('UPDATE counters SET value = value + ? WHERE tbl = ? AND key = ?',
+                                    (amount, table, key))
+                else:
+                    self.db.execute('UPDATE counters SET value = value + ?, expires = max(coalesce(expires, ?), ?) '
+                                    'WHERE tbl = ? AND key = ?', (amount, expires, expires, table, key))
+            self.db.execute('COMMIT')
+        except sqlite3.Error:
+            self.db.execute('ROLLBACK')
+            raise
+        self.pending.clear()
+        # Read back the totals of the counters used since the last flush, to
+        # pick up what other processes added to them
+        tables = {}
+        for table, key in self.used:
+            tables.setdefault(table, []).append(key)
+        self.used = set()
+        for table, keys in tables.items():
+            # SQLite limits how many parameters one query takes
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                for key in chunk:
+                    self.known.pop((table, key), None)
+                rows = self.db.execute('SELECT key, value, expires FROM counters WHERE tbl = ? AND key IN ({marks})'.format(
+                                       marks = ', '.join('?' * len(chunk))), [table] + chunk)
+                # Only counters that exist are cached, and they take their
+                # expiry along, so expire() also drops the ones that other
+                # processes added to
+                for key, value, expires in rows:
+                    entry = (table, key)
+                    self.known[entry] = value
+                    if expires is not None:
+                        self.expiries[entry] = max(expires, self.expiries.get(entry, expires))
+        self.lastFlush = time.monotonic()
+
+    def flush(self):
+        with self.lock:
+            if self.pending:
+                self.write()
+
+    def expire(self, now):
+        # Deleting takes the write lock, so it only happens every so often
+        if self.nextExpiry is not None and now < self.nextExpiry:
+            return
+        self.nextExpiry = now + self.expireInterval
+        with self.lock:
+            self.db.execute('DELETE FROM records WHERE expires <= ?', (now,))
+            self.db.execute('DELETE FROM counters WHERE expires <= ?', (now,))
+            for entry in [entry for entry, expires in self.expiries.items() if expires <= now]:
+                del self.expiries[entry]
+                self.known.pop(entry, None)
+
+    def clear(self):
+        with self.lock:
+            self.db.execute('DELETE FROM records')
+            self.db.execute('DELETE FROM counters')
+            self.known.clear()
+            self.used.clear()
+            self.pending.clear()
+            self.expiries.clear()
+
+    def close(self):
+        if self.db is None:
+            return
+        self.flush()
+        with self.lock:
+            self.db.close()
+            self.db = None
@@ -0,0 +1,90 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 QuiteQuiet
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Checking a message for stretching used to be a backtracking regex. Rooms
+# check the names of their users once when they join, so this is used outside
+# of moderation as well.
+
+
+# Constants, see moderation.configure
+def MIN_STRETCH_RUN(): return 10
+def MIN_STRETCH_REPEATS(): return 6
+def MAX_STRETCH_PERIOD(): return 0
+
+def foldCase(line):
+    if not line or max(line) < '\x80':
+        return line.lower()
+    # Lower casing a whole string treats a final 'Σ' differently, and a few
+    # characters like 'İ' turn into more than one, so go one at a time
+    return ''.join(char.lower()[0] for char in line)
+def toBytes(line):
+    # Only equality between characters matters, so any text with fewer than
+    # 256 different characters can be turned into one byte per character
+    try:
+        return line.encode('latin-1')
+    except UnicodeEncodeError:
+        codes = {}
+        for char in line:
+            codes.setdefault(char, len(codes))
+        if len(codes) > 256:
+            return None
+        return bytes(codes[char] for char in line)
+def hasRepeat(line, period, repeats):
+    # Slow path for lines with too many different characters for toBytes
+    needed, matched = (repeats - 1) * period, 0
+    for a, b in zip(line, line[period:]):
+        matched = matched + 1 if a == b else 0
+        if matched >= needed:
+            return True
+    return False
+def triggersStretching(text):
+    # A message is stretching if it has a character repeated MIN_STRETCH_RUN
+    # times in a row, or a block of two or more characters repeated
+    # MIN_STRETCH_REPEATS times in a row, ignoring case.
+    # A block of length p repeats r times from i exactly when line[k] equals
+    # line[k + p] for the (r - 1) * p positions k from i on. Packing the line
+    # into an int, shifting it by p characters and xoring it with itself
+    # turns every such k into a zero byte, so every period is one pass that
+    # looks for a long enough row of zero bytes.
+    for line in text.split('\n'):
+        line = foldCase(line)
+        length = len(line)
+        periods = [(1, MIN_STRETCH_RUN())]
+        longest = length // MIN_STRETCH_REPEATS()
+        if MAX_STRETCH_PERIOD():
+            longest = min(longest, MAX_STRETCH_PERIOD())
+        periods.extend((period, MIN_STRETCH_REPEATS()) for period in range(2, longest + 1))
+        packed = toBytes(line)
+        if packed is None:
+            if any(hasRepeat(line, period, repeats) for period, repeats in periods):
+                return True
+            continue
+        number = int.from_bytes(packed, 'big')
+        for period, repeats in periods:
+            if period * repeats > length:
+                continue
+            shifted = number >> (8 * period)
+            tail = number & ((1 << (8 * (length - period))) - 1)
+            same = (shifted ^ tail).to_bytes(length - period, 'big')
+            if bytes((repeats - 1) * period) in same:
+                return True
+    return False
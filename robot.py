@@ -45,8 +45,9 @@ import re
 
 from room import Room
 from user import User
+from user import users
 from plugins.battling.battleHandler import BattleHandler
-from plugins.math.markov import Markov 
+from plugins.math.markov import Markov, DEFAULT_BUDGET, DEFAULT_WEIGHT, ROOM_BUDGET
 from plugins.math.clever import Clever
 
 class PokemonShowdownBot:
@@ -63,6 +64,7 @@ class PokemonShowdownBot:
         rooms: Room object, that keeps track of information in a given room.
         rooms_markov: a map mapping room names to markov objects used to 
                       generate sentences for certain rooms.
+        markov: Markov object, the model every room's model builds on.
         commandchar: string, string that is used to execute certain commands.
         url: string, the url for pokemon showdown's open port that the 
              websocket will attempt connecting to.
@@ -71,10 +73,15 @@ class PokemonShowdownBot:
         with open("details.yaml", 'r') as yaml_file:
             self.details = yaml.load(yaml_file)
             self.owner = self.toId(self.details['master'])
+            users.owner = self.owner
             self.name = self.details['user']
             self.id = self.toId(self.name)
             self.rooms = {}
             self.rooms_markov = {}
+            budget = self.details.get('markovbudget')
+            self.markov = Markov('global', file_name = '',
+                                 budget = budget * 2**20 if budget else DEFAULT_BUDGET,
+                                 background = True)
             self.commandchar = self.details['command']
             self.intro()
             self.splitMessage = onMessage if onMessage else self.onMessage
@@ -192,10 +199,21 @@ class PokemonShowdownBot:
                   example:
                     data = {'moderate': False, 'allow games': False,
                             'tourwhitelist': []}
+
+        The room's markov model loads in the background, so the rooms after
+        it are joined right away.
         """
         self.send('|/join ' + room)
-        self.rooms_markov[room] = Markov(room)
+        budget = self.details.get('markovroombudget')
+        weight = self.details.get('markovweight')
+        self.rooms_markov[room] = Markov(room, budget = budget * 2**20 if budget else ROOM_BUDGET,
+                                         shared = self.markov,
+                                         weight = DEFAULT_WEIGHT if weight is None else weight,
+                                         background = True)
+        if isinstance(self.rooms.get(room), Room):
+            self.rooms[room].clearUsers()
         self.rooms[room] = Room(room, data)
+        users.track(self.rooms[room])
 
     def leaveRoom(self, room):
         ''' Attempts to leave a PS room
@@ -209,7 +227,10 @@ class PokemonShowdownBot:
                   """.format(name = self.name, room = room))
             return False
         self.send('|/leave ' + room)
-        self.rooms.pop(room, None)
+        left = self.rooms.pop(room)
+        # battle rooms are only marked with True
+        if isinstance(left, Room):
+            left.clearUsers()
         return True
 
     def getRoom(self, roomName):
@@ -329,7 +350,9 @@ class PokemonShowdownBot:
             room = self.getRoom(e)
             details['joinRooms'].append({e:{'moderate':room.moderate,
                                             'allow games':room.allowGames,
-                                            'tourwhitelist':room.tourwhitelist}
+                                            'tourwhitelist':room.tourwhitelist,
+                                            'linkwhitelist':list(room.linkwhitelist),
+                                            'rules':sorted(room.rules) if room.rules is not None else None}
                                         })
         details['rooms'] = {}
         with open('details.yaml', 'w') as yf:
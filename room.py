@@ -27,13 +27,24 @@
 
 
 from plugins.tournaments import Tournament
+from plugins.domains import DomainIndex
+from plugins.names import NameMatcher
+from plugins.stretching import triggersStretching
+from user import Member
+from user import users
 
 
 class Room:
     """ Contains all important information of a pokemon showdown room. 
     
     Attributes:
-        users: map, maps user ids to users. 
+        users: map, maps the ids of the users in this room to their rank
+               here. The users themselves are kept by the UserRegistry.
+        strays: map, maps ids to the users of a room the UserRegistry doesn't
+                count, see UserRegistry.track.
+        names: NameMatcher object, the names of every user in this room.
+        stretchingNames: NameMatcher object, the names and ids of users in
+                         this room that would be caught as stretching.
         loading: Bool, if this room is still loading information.
         title: string, name of the room.
         rank: string, the rank of this bot in this room.
@@ -43,14 +54,22 @@ class Room:
         game: Workshop object, if this room is a workshop.  
         tourwhiteList: list of str, users who are not moderators but who have
                        permission to start a tour. 
+        linkwhitelist: DomainIndex object, domains that can be linked in this
+                       room on top of the global whitelist.
+        rules: set of str, the moderation rules used in this room, or None
+               to use the default ones.
     """
     def __init__(self, room, data=None):
         """Intializes room with preliminary information."""
         if not data:
             # This is to support both strings and dicts as input
             data = {'moderate': False, 'allow games': False,
-                    'tourwhitelist': [], 'broadcastrank':' '}
+                    'tourwhitelist': [], 'broadcastrank':' ',
+                    'linkwhitelist': []}
         self.users = {}
+        self.strays = {}
+        self.names = NameMatcher()
+        self.stretchingNames = NameMatcher()
         self.loading = True
         self.title = room
         self.broadcast_rank = data['broadcastrank'] 
@@ -60,20 +79,60 @@ class Room:
         self.tour = None
         self.game = None
         self.tourwhitelist = data['tourwhitelist']
+        # Older details.yaml files don't have this setting
+        self.linkwhitelist = DomainIndex(data.get('linkwhitelist', []))
+        self.rules = set(data['rules']) if data.get('rules') is not None else None
 
     def doneLoading(self):
         """Set loading status to False"""
         self.loading = False
 
-    def addUser(self, user):
+    def addUser(self, member):
         """Adds user to room."""
-        if user.id not in self.users:
-            self.users[user.id] = user
+        if member.id not in self.users:
+            self.users[member.id] = member.rank
+            if self in users.rooms:
+                user = users.enter(member.user)
+            else:
+                user = self.strays.setdefault(member.id, member.user)
+            self.addNames(user)
+
+    def addNames(self, user):
+        """Adds the names of a user to the ones matched in this room."""
+        self.names.add(user.name)
+        # Checked once here rather than on every message they send
+        for name in {user.id, user.name}:
+            if triggersStretching(name):
+                self.stretchingNames.add(name)
+
+    def addUsers(self, members):
+        """Adds the users of a userlist to room."""
+        for member in members:
+            self.addUser(member)
 
     def removeUser(self, userid):
         """Removes user from this room."""
         if userid in self.users:
-            return self.users.pop(userid)
+            rank = self.users.pop(userid)
+            if self in users.rooms:
+                user = users.leave(userid)
+            else:
+                user = self.strays.pop(userid)
+            self.removeNames(user)
+            return Member(user, rank)
+
+    def removeNames(self, user):
+        """Removes the names of a user from the ones matched in this room."""
+        self.names.remove(user.name)
+        for name in {user.id, user.name}:
+            if triggersStretching(name):
+                self.stretchingNames.remove(name)
+
+    def clearUsers(self):
+        """Removes every user, for when the bot leaves this room."""
+        for userid in list(self.users):
+            self.removeUser(userid)
+        users.rooms.discard(self)
 
     def renamedUser(self, old, new):
         """updates user credentials."""
@@ -83,7 +142,8 @@ class Room:
     def getUser(self, name):
         """Returns true if this user is in this room."""
         if name in self.users:
-            return self.users[name]
+            user = users.users[name] if self in users.rooms else self.strays[name]
+            return Member(user, self.users[name])
         else:
             return False
 
@@ -105,6 +165,14 @@ class Room:
         self.tourwhitelist.remove(target)
         return True
 
+    def addToLinkWhitelist(self, domain):
+        """Returns true if the domain was added to the link whitelist."""
+        return self.linkwhitelist.add(domain)
+
+    def delFromLinkWhitelist(self, domain):
+        """Returns true if the domain was removed from the link whitelist."""
+        return self.linkwhitelist.remove(domain)
+
     def createTour(self, ws, form):
         """Creates a tour with the specified format.
         
@@ -186,9 +254,37 @@ def untourwl(bot, cmd, room, msg, user):
               in this room.""".format(name=msg), True
 
 
+def linkwl(bot, cmd, room, msg, user):
+    '''(PSBot, str, Room, str, User) -> (str, Bool)'''
+    if not user.hasRank('#'):
+        return 'You do not have permission to change this. (Requires #)', False
+    domain = bot.removeSpaces(msg).lower()
+    if not domain:
+        return 'No domain given. Command is ~linkwl [domain]', False
+    if not room.addToLinkWhitelist(domain):
+        return 'This domain is already whitelisted in that room.', False
+    bot.saveDetails()
+    return """{domain} added to the link whitelist in this
+              room.""".format(domain=domain), True
+
+
+def unlinkwl(bot, cmd, room, msg, user):
+    '''(PSBot, str, Room, str, User) -> (str, Bool)'''
+    if not user.hasRank('#'):
+        return 'You do not have permission to change this. (Requires #)', False
+    domain = bot.removeSpaces(msg).lower()
+    if not room.delFromLinkWhitelist(domain):
+        return 'This domain is not whitelisted in that room.', False
+    bot.saveDetails()
+    return """{domain} removed from the link whitelist
+              in this room.""".format(domain=domain), True
+
+
 RoomCommands = {
     'allowgames': allowgames,
     'tour': tour,
     'tourwl': tourwl,
-    'untourwl': untourwl
+    'untourwl': untourwl,
+    'linkwl': linkwl,
+    'unlinkwl': unlinkwl
 }
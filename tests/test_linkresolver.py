@@ -0,0 +1,134 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 QuiteQuiet
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Checks badLink against a local redirect server standing in for a shortener,
+# so the tests don't need the network.
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import threading
+import time
+import unittest
+
+from plugins import moderation
+from plugins.linkresolver import LinkResolver
+from plugins.domains import DomainIndex
+
+
+class ThreadedServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class Redirector(BaseHTTPRequestHandler):
+    """Redirects /short to /landing on 127.0.0.1, and /slow the same way
+    after taking longer than the resolver is willing to wait."""
+    hits = 0
+
+    def do_HEAD(self):
+        Redirector.hits += 1
+        if self.path == '/slow':
+            time.sleep(1.5)
+        if self.path in ('/short', '/slow'):
+            self.send_response(302)
+            self.send_header('Location', 'http://127.0.0.1:{}/landing'.format(self.server.server_port))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    do_GET = do_HEAD
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeRoom:
+    def __init__(self, whitelist):
+        self.linkwhitelist = DomainIndex(whitelist)
+
+
+class BadLinkTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadedServer(('127.0.0.1', 0), Redirector)
+        cls.thread = threading.Thread(target = cls.server.serve_forever, daemon = True)
+        cls.thread.start()
+        # The server is reached as localhost and redirects to 127.0.0.1, so
+        # the shortener and the target have different hosts
+        cls.short = 'localhost:{}/short'.format(cls.server.server_port)
+        cls.slow = 'localhost:{}/slow'.format(cls.server.server_port)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.saved = moderation.linkResolver, moderation.shortenerDomains
+        self.resolver = LinkResolver(timeout = 0.3)
+        moderation.linkResolver = self.resolver
+        moderation.shortenerDomains = DomainIndex(['localhost'])
+        self.reported = []
+
+    def tearDown(self):
+        self.resolver.pool.shutdown(wait = True)
+        moderation.linkResolver, moderation.shortenerDomains = self.saved
+
+    def onResolved(self):
+        self.reported.append(True)
+
+    def finish(self):
+        # Waits for the workers, callbacks included
+        self.resolver.pool.shutdown(wait = True)
+
+    def test_bad_target_is_reported_later(self):
+        start = time.monotonic()
+        self.assertFalse(moderation.badLink(self.short, None, self.onResolved))
+        self.assertLess(time.monotonic() - start, self.resolver.timeout)
+        self.finish()
+        self.assertEqual(self.reported, [True])
+
+    def test_whitelisted_target_passes(self):
+        room = FakeRoom(['127.0.0.1'])
+        self.assertFalse(moderation.badLink(self.short, room, self.onResolved))
+        self.finish()
+        self.assertEqual(self.reported, [])
+
+    def test_cache_hit(self):
+        moderation.badLink(self.short, None, self.onResolved)
+        self.finish()
+        hits = Redirector.hits
+        found, target = self.resolver.lookup(self.short)
+        self.assertTrue(found)
+        self.assertTrue(target.endswith('/landing'))
+        self.assertTrue(moderation.badLink(self.short))
+        self.assertFalse(moderation.badLink(self.short, FakeRoom(['127.0.0.1'])))
+        self.assertEqual(Redirector.hits, hits)
+
+    def test_timeout(self):
+        start = time.monotonic()
+        self.assertFalse(moderation.badLink(self.slow, None, self.onResolved))
+        self.finish()
+        self.assertLess(time.monotonic() - start, 1.5)
+        self.assertEqual(self.reported, [])
+        self.assertEqual(self.resolver.lookup(self.slow), (True, ''))
+        self.assertFalse(moderation.badLink(self.slow))
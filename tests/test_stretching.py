@@ -0,0 +1,77 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 QuiteQuiet
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# triggersStretching replaced a backtracking regex, so it is fuzzed against
+# that regex to make sure the verdicts didn't change.
+
+import random
+import re
+import unittest
+
+from plugins import moderation
+
+STRETCH_REGEX = re.compile(r'((.)\2{9,})|((..+)\4{5,})', flags = re.I)
+
+# Mixed case, final sigma, the Kelvin sign, a dotted capital I and CJK text
+# all fold differently, and newlines stop the regex's '.'
+ALPHABETS = ['ab', 'aAbB', 'abc \n', 'ΣσςkKK', 'İiı', '猫ネコ', 'xyz.!?']
+
+
+def randomLine(rng):
+    alphabet = rng.choice(ALPHABETS)
+    length = rng.randint(0, 120)
+    line = ''
+    while len(line) < length:
+        if rng.random() < 0.1:
+            block = ''.join(rng.choice(alphabet) for _ in range(rng.randint(1, 6)))
+            line += block * rng.randint(2, 8)
+        else:
+            line += rng.choice(alphabet)
+    return line
+
+
+class StretchingTest(unittest.TestCase):
+    def assertSameVerdict(self, line):
+        self.assertEqual(moderation.triggersStretching(line),
+                         bool(STRETCH_REGEX.search(line)), repr(line))
+
+    def test_known_lines(self):
+        for line in ['', 'hello there', 'a' * 9, 'a' * 10, 'A' * 5 + 'a' * 5,
+                     'ab' * 5, 'ab' * 6, 'aB' * 3 + 'Ab' * 3, 'ab' * 3 + '\n' + 'ab' * 3,
+                     'σ' * 5 + 'Σ' * 5, 'K' * 10, 'ha ' * 6, '猫' * 10]:
+            self.assertSameVerdict(line)
+
+    def test_fuzz(self):
+        rng = random.Random(36)
+        for _ in range(5000):
+            self.assertSameVerdict(randomLine(rng))
+
+    def test_many_distinct_characters(self):
+        # More than 256 different characters takes the path without bytes
+        rng = random.Random(37)
+        pool = [chr(0x4e00 + i) for i in range(400)]
+        for _ in range(200):
+            line = ''.join(rng.sample(pool, 300))
+            if rng.random() < 0.5:
+                start = rng.randrange(len(line))
+                line = line[:start] + line[start:start + rng.randint(1, 4)] * rng.randint(5, 11) + line[start:]
+            self.assertSameVerdict(line)
@@ -0,0 +1,98 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 QuiteQuiet
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Links are looked for with the spaces taken out, which must not glue the
+# word in front of a link onto its host.
+
+import random
+import unittest
+
+from plugins import moderation
+from plugins.domains import DomainIndex
+
+
+class FakeRoom:
+    def __init__(self, domains):
+        self.linkwhitelist = DomainIndex(domains)
+
+
+class LinkHostTest(unittest.TestCase):
+    def hosts(self, text):
+        return [moderation.getHost(link) for link in moderation.Features(text).links()]
+
+    def test_link_in_a_sentence(self):
+        self.assertEqual(self.hosts('check smogon.com/forums'), ['smogon.com'])
+        self.assertEqual(self.hosts('see pokemonshowdown.com!'), ['pokemonshowdown.com'])
+        self.assertEqual(self.hosts('go to bit.ly/x'), ['bit.ly'])
+        room = FakeRoom([])
+        for text in ['check smogon.com/forums', 'see pokemonshowdown.com!']:
+            self.assertFalse(moderation.checkLinks(moderation.Features(text), None, room, None, None), text)
+
+    def test_room_whitelist_in_a_sentence(self):
+        text = 'look at example.org/page'
+        self.assertTrue(moderation.checkLinks(moderation.Features(text), None, FakeRoom([]), None, None))
+        self.assertFalse(moderation.checkLinks(moderation.Features(text), None, FakeRoom(['example.org']), None, None))
+
+    def test_spaced_out_links(self):
+        self.assertEqual(self.hosts('evil . com/x'), ['evil.com'])
+        self.assertEqual(self.hosts('a smogon.com b evil.net/x'), ['smogon.com', 'evil.net'])
+        self.assertTrue(moderation.checkLinks(moderation.Features('a smogon.com b evil.net/x'),
+                                              None, FakeRoom([]), None, None))
+
+
+# findUrls only runs URL_REGEX from the places a link can start, so it is
+# fuzzed against running the regex over the whole text.
+
+# Pieces of links, and the characters around them that the regex treats
+# specially
+PIECES = ['http', 'https', '://', ':', '/', '//', 'www', '.', '.com', '.co', '.org',
+          '.jp', '.ab', '.abcd', '@', '-', '8080', 'a', 'b', 'x1', ' ', '  ', '(', ')',
+          '?', '!', ',', '"', '[', '<', '_', 'é']
+
+
+def randomText(rng):
+    return ''.join(rng.choice(PIECES) for _ in range(rng.randint(0, 25)))
+
+
+class FindUrlsTest(unittest.TestCase):
+    def assertSameUrls(self, text):
+        expected = [match.group(0) for match in
+                    moderation.URL_REGEX.finditer(text.replace(' ', ''))]
+        self.assertEqual(moderation.getUrls(text), expected, repr(text))
+
+    def test_known_texts(self):
+        for text in ['', 'hello', 'smogon.com', 'see smogon.com/forums.', 'http: //foo',
+                     'http:/ /foo', 'www . x', 'a.b@c.com', 'mail a@b', 'a.ab:80/x',
+                     'x.com y.org', '(see example.com/a_(b))', 'tk.to/x']:
+            self.assertSameUrls(text)
+
+    def test_fuzz(self):
+        rng = random.Random(37)
+        for _ in range(5000):
+            self.assertSameUrls(randomText(rng))
+
+    def test_configured_regex(self):
+        try:
+            moderation.configure({'URL_REGEX': r'[a-z]+:[0-9]+'})
+            self.assertEqual(moderation.getUrls('go to host:80 now'), ['gotohost:80'])
+        finally:
+            moderation.configure({})
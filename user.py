@@ -19,34 +19,149 @@
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
-import re
+import weakref
+
+# What re.sub(r'[^a-zA-z0-9]', '', name) kept, which the ids are made of
+ID_CHARS = frozenset(chr(c) for c in range(ord('0'), ord('9') + 1)) | frozenset(chr(c) for c in range(ord('A'), ord('z') + 1))
+
+
+def toId(name):
+    """Returns the id of a username."""
+    return ''.join([c for c in name if c in ID_CHARS]).lower()
 
 
 class User:
     """Very basic class for a pokemon showdown user.
+
+    There is one User per id however many rooms the user is in, kept by
+    UserRegistry. Ranks differ between rooms, so those are kept by the rooms
+    and handed out with the user by Member.
     Attributes:
         Groups: map, ranks presedence of user ranks by symbols.
         name:string, username.
         id:string, simplifid unique username.
-        rank:string, user rank.
         owner:Bool, is this you.
+        rooms:int, how many rooms the user is known to be in.
     """
     Groups = {' ': 0, '+': 1, '★': 1, '%': 2, '@': 3, '&': 4, '#': 5, '~': 6}
+    __slots__ = ('name', 'id', 'owner', 'rooms')
 
-    def __init__(self, name, rank, owner=False):
+    def __init__(self, name, owner=False):
         """Initializes user.
         Args:
             name:string, username.
-            rank:string, user rank.
             owner:Bool, is this you.
         """
         self.name = name
-        self.id = re.sub(r'[^a-zA-z0-9]', '', name).lower()
-        self.rank = rank
+        self.id = toId(name)
         self.owner = owner
+        self.rooms = 0
+
+    def isOwner(self):
+        return self.owner
+
+
+class Member:
+    """A user in a room, or in a pm, with the rank they have there.
+
+    This is what commands and moderation are given as the user. Rooms only
+    keep the ranks, and make these when asked for a user.
+    Attributes:
+        user: User object, the user.
+        rank:string, user rank.
+    """
+    __slots__ = ('user', 'rank')
+
+    def __init__(self, user, rank):
+        self.user = user
+        self.rank = rank
+
+    @property
+    def name(self):
+        return self.user.name
+
+    @property
+    def id(self):
+        return self.user.id
+
+    @property
+    def owner(self):
+        return self.user.owner
 
     def hasRank(self, rank):
-        return self.owner or User.Groups[self.rank] >= User.Groups[rank]
+        return self.user.owner or User.Groups[self.rank] >= User.Groups[rank]
 
     def isOwner(self):
-        return self.owner
+        return self.user.owner
+
+
+class UserRegistry:
+    """Keeps one User per id for the whole process.
+
+    Users are kept while they are in a room the bot is in, see Room.addUser
+    and Room.removeUser, and forgotten once they have left them all. Only the
+    rooms the bot has joined count, so the throwaway rooms made for pms or
+    for messages from rooms it isn't in keep their users to themselves.
+    Attributes:
+        owner: string, id of the user the bot belongs to.
+        users: maps ids to the users in any room.
+        rooms: WeakSet of Room objects, the rooms whose users are counted.
+    """
+    def __init__(self):
+        self.owner = None
+        self.users = {}
+        self.rooms = weakref.WeakSet()
+
+    def get(self, name):
+        """Returns the User with this username.
+
+        A user known under another display name, like a new capitalization,
+        is renamed in every room they are in.
+        """
+        userid = toId(name)
+        user = self.users.get(userid)
+        if user is None:
+            user = User(name, userid == self.owner)
+        elif user.name != name:
+            self.rename(user, name)
+        return user
+
+    def rename(self, user, name):
+        """Changes the display name of a user in the rooms they are in."""
+        rooms = [room for room in self.rooms if user.id in room.users]
+        for room in rooms:
+            room.removeNames(user)
+        user.name = name
+        for room in rooms:
+            room.addNames(user)
+
+    def track(self, room):
+        """Counts the users of a room the bot has joined from now on."""
+        self.rooms.add(room)
+
+    def member(self, name, rank):
+        """Returns a Member for a username and their rank."""
+        return Member(self.get(name), rank)
+
+    def members(self, entries):
+        """Returns Members for a list of ranks followed by usernames, like in
+        a |users| message.
+        """
+        return [Member(self.get(entry[1:]), entry[0]) for entry in entries]
+
+    def enter(self, user):
+        """Notes that a user is in one more room."""
+        user = self.users.setdefault(user.id, user)
+        user.rooms += 1
+        return user
+
+    def leave(self, userid):
+        """Notes that a user is in one room less, and returns them."""
+        user = self.users[userid]
+        user.rooms -= 1
+        if not user.rooms:
+            del self.users[userid]
+        return user
+
+
+users = UserRegistry()